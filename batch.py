@@ -0,0 +1,99 @@
+"""Headless text-to-SQL: generate and validate SQL for a file of questions.
+
+    python batch.py questions.txt --catalog main --schema sales --tables orders,customers --output results.jsonl
+
+The questions file has one question per line (or is JSONL with a "question" field). Results are appended to
+the output as each question completes, so an interrupted run continues where it stopped when started again
+(unless --no-resume is given). Questions that failed with an error are tried again. An output ending in
+.parquet is written from that JSONL checkpoint at the end.
+"""
+import argparse
+import json
+import os, sys, time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from engine import *
+
+def read_questions(path):
+    """Read the questions from a text file (one per line) or a JSONL file with a "question" field"""
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line: continue
+            questions.append(json.loads(line)["question"] if line.startswith("{") else line)
+    return list(dict.fromkeys(questions)) # Drop duplicates, keep the order
+
+def read_checkpoint(path):
+    """Questions already answered in a previous run. Questions that failed with an exception (e.g. a transient
+    LLM or warehouse error) are not counted, so they are tried again. The last result of a question wins"""
+    statuses = {}
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                    statuses[result["question"]] = result.get("status")
+                except (ValueError, KeyError):
+                    pass # Partially written last line of an interrupted run
+    return {question for question, status in statuses.items() if status != 'Failed'}
+
+def answer_question(question, table_schema):
+    """Generate SQL for one question and run it through the bounded self-correction loop"""
+    start = time.monotonic()
+    try:
+        correction = generate_valid_sql(question, table_schema)
+        return {'question': question, 'sql': correction.sql, 'status': correction.status, 'source': correction.source, 'attempts': len(correction.attempts),
+                'error': correction.error_msg, 'latency_s': round(time.monotonic() - start, 3)}
+    except Exception as e:
+        return {'question': question, 'sql': None, 'status': 'Failed', 'source': None, 'attempts': 0, 'error': str(e),
+                'latency_s': round(time.monotonic() - start, 3)}
+
+def run_batch(questions, catalog, schema, tables_list, output_path, concurrency=4, resume=True):
+    """Answer all the questions against one schema context, appending each result to output_path as JSONL.
+    Returns the results of this run"""
+    checkpoint_path = output_path + ".checkpoint.jsonl" if output_path.endswith(".parquet") else output_path
+    if not resume and os.path.exists(checkpoint_path): os.remove(checkpoint_path)
+    done = read_checkpoint(checkpoint_path)
+    pending = [question for question in questions if question not in done]
+
+    table_schema = database_context_for_llm(catalog, schema, tables_list) # Built once for the whole batch
+
+    results = []
+    with open(checkpoint_path, "a", encoding="utf-8") as checkpoint, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(answer_question, question, table_schema) for question in pending]
+        for future in as_completed(futures):
+            result = future.result()
+            checkpoint.write(json.dumps(result) + "\n")
+            checkpoint.flush()
+            results.append(result)
+            print(f"[{len(results)}/{len(pending)}] {result['status']} ({result['latency_s']}s): {result['question']}", file=sys.stderr)
+
+    if output_path.endswith(".parquet"):
+        # Retried questions appear once per attempt, keep their latest result
+        pd.read_json(checkpoint_path, lines=True).drop_duplicates('question', keep='last').to_parquet(output_path, index=False)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate and validate SQL for a file of questions")
+    parser.add_argument("questions", help="Text file with one question per line, or JSONL with a question field")
+    parser.add_argument("--catalog", required=True)
+    parser.add_argument("--schema", required=True)
+    parser.add_argument("--tables", help="Comma separated tables (default: every table in the schema)")
+    parser.add_argument("--output", default="results.jsonl", help="Output .jsonl or .parquet file")
+    parser.add_argument("--concurrency", type=int, default=4, help="Questions processed at the same time")
+    parser.add_argument("--no-resume", action="store_true", help="Start over instead of skipping answered questions")
+    args = parser.parse_args(argv)
+
+    if args.tables:
+        tables_list = [table.strip() for table in args.tables.split(",") if table.strip()]
+    else:
+        tables_list = list_tables(args.catalog, args.schema)
+
+    results = run_batch(read_questions(args.questions), args.catalog, args.schema, tables_list, args.output,
+                        concurrency=args.concurrency, resume=not args.no_resume)
+    successful = sum(result['status'] == 'Successful' for result in results)
+    print(f"{successful}/{len(results)} questions produced valid SQL. Results written to {args.output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
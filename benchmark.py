@@ -0,0 +1,299 @@
+"""Offline benchmark of the text-to-SQL pipeline.
+
+Runs the engine against a local SQLite stand-in for the Databricks warehouse (synthetic schemas with wide string
+columns) and a deterministic fake chat model with a configurable latency, so no network or credentials are needed.
+
+    python benchmark.py --sizes 10 100 1000 --repeats 5 --llm-latency 0.05 --output bench.json
+    python benchmark.py --baseline bench.json  # exits with 1 when a stage got slower than the tolerance
+    python benchmark.py --sizes --import-modules engine history  # only the cold import times (python -X importtime)
+
+Every stage starts cold: the Streamlit caches are cleared and fresh on-disk metadata/LLM caches are used.
+"""
+import argparse
+import json
+import logging
+import os, re, sys, time
+import sqlite3
+import subprocess
+import tempfile
+import tracemalloc
+import warnings
+
+import numpy as np
+from langchain_core.language_models.chat_models import SimpleChatModel
+
+import engine
+
+warnings.filterwarnings("ignore") # pandas warns about non-SQLAlchemy DBAPI connections
+logging.getLogger("streamlit").setLevel(logging.ERROR)
+
+CATALOG, SCHEMA = "main", "sales"
+
+class SQLiteWarehouse:
+    """In-memory SQLite database answering the Databricks statements the engine issues"""
+
+    def __init__(self, n_tables, n_string_columns=20, n_numeric_columns=5, n_rows=200, seed=0):
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
+        self.queries = 0
+        rng = np.random.default_rng(seed)
+        self.tables = [f"table_{i:04d}" for i in range(n_tables)]
+        for index, table in enumerate(self.tables):
+            # Every table references the previous one so the ERD and join heuristics have something to find
+            columns = ["id INT"] + ([f"{self.tables[index-1]}_id INT"] if index else [])
+            columns += [f"category_{j} STRING" if j % 2 else f"text_{j} STRING" for j in range(n_string_columns)]
+            columns += [f"metric_{j} DOUBLE" for j in range(n_numeric_columns)]
+            self.db.execute(f"CREATE TABLE {table} ({', '.join(columns)})")
+            rows = []
+            for row in range(n_rows):
+                values = [row] + ([int(rng.integers(n_rows))] if index else [])
+                values += [f"value_{rng.integers(5)}" if j % 2 else f"text_{rng.integers(10**6)}" for j in range(n_string_columns)]
+                values += [float(rng.random()) for _ in range(n_numeric_columns)]
+                rows.append(values)
+            self.db.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * len(rows[0]))})", rows)
+
+    def connect(self):
+        return _Connection(self)
+
+    def columns(self, table):
+        return [(name, data_type.lower()) for _, name, data_type, *_ in self.db.execute(f"PRAGMA table_info({table})")]
+
+    def execute(self, query):
+        """Run a query, returning (column names, rows)"""
+        self.queries += 1
+        query = query.strip().rstrip(";")
+        upper = query.upper()
+        names = lambda: re.findall(r"'(\w+)'", query.split("IN", 1)[-1])
+        if upper == "SELECT 1":
+            return ["1"], [(1,)]
+        if "INFORMATION_SCHEMA.COLUMNS" in upper:
+            return ["table_name", "column_name", "data_type"], [(table, column, data_type) for table in names() for column, data_type in self.columns(table)]
+        if "INFORMATION_SCHEMA.TABLES" in upper:
+            return ["table_name", "version"], [(table, "2024-01-01 00:00:00") for table in names() if table in self.tables]
+        table = query.replace("`", "").split(".")[-1].split()[0] if upper.startswith(("SHOW CREATE", "DESCRIBE")) else None
+        if upper.startswith("SHOW CREATE TABLE"):
+            ddl = self.db.execute("SELECT sql FROM sqlite_master WHERE name = ?", (table,)).fetchone()[0]
+            return ["createtab_stmt"], [(ddl.replace(f"CREATE TABLE {table}", f"CREATE TABLE {CATALOG}.{SCHEMA}.{table}") + " USING delta",)]
+        if upper.startswith("DESCRIBE HISTORY"):
+            return ["version", "timestamp"], [(0, "2024-01-01 00:00:00")]
+        if upper.startswith("DESCRIBE DETAIL"):
+            return ["lastModified"], [("2024-01-01 00:00:00",)]
+        if upper.startswith("DESCRIBE"):
+            return ["col_name", "data_type", "comment"], [(column, data_type, None) for column, data_type in self.columns(table)]
+
+        # Translate the Databricks SQL dialect to SQLite
+        query = re.sub(r"`?\w+`?\.`?\w+`?\.`?(\w+)`?", r"\1", query)
+        query = re.sub(r"TABLESAMPLE\s*\([^)]*\)", "", query, flags=re.I)
+        query = re.sub(r"approx_count_distinct\((\w+)\)", r"COUNT(DISTINCT \1)", query, flags=re.I)
+        query = re.sub(r"slice\(ARRAY_AGG\(DISTINCT (\w+)\),\s*\d+,\s*\d+\)", r"json_group_array(DISTINCT \1)", query, flags=re.I)
+        query = re.sub(r"ARRAY_AGG\(DISTINCT (\w+)\)", r"json_group_array(DISTINCT \1)", query, flags=re.I)
+        query = re.sub(r"\bAS values\b", 'AS "values"', query, flags=re.I)
+        query = re.sub(r"^EXPLAIN\s", "EXPLAIN QUERY PLAN ", query, flags=re.I)
+        cursor = self.db.execute(query)
+        columns = [column[0] for column in cursor.description or []]
+        rows = cursor.fetchall()
+        if "values" in columns:
+            index = columns.index("values")
+            rows = [tuple(json.loads(value) if i == index else value for i, value in enumerate(row)) for row in rows]
+        return columns, rows
+
+class _Cursor:
+    def __init__(self, warehouse):
+        self.warehouse = warehouse
+        self.description, self._rows = None, []
+
+    def execute(self, query, parameters=None):
+        columns, self._rows = self.warehouse.execute(query)
+        self.description = [(column, None, None, None, None, None, None) for column in columns]
+
+    def catalogs(self):
+        self.warehouse.queries += 1
+        self._rows = [(CATALOG,)]
+
+    def schemas(self, catalog_name=None, **kwargs):
+        self.warehouse.queries += 1
+        self._rows = [(SCHEMA, CATALOG)] if catalog_name in (None, CATALOG) else []
+
+    def tables(self, catalog_name=None, schema_name=None, **kwargs):
+        self.warehouse.queries += 1
+        self.description = [(column, None, None, None, None, None, None) for column in ("TABLE_CAT", "TABLE_SCHEM", "TABLE_NAME", "TABLE_TYPE")]
+        matches = catalog_name in (None, CATALOG) and schema_name in (None, SCHEMA)
+        self._rows = [(CATALOG, SCHEMA, table, "TABLE") for table in self.warehouse.tables] if matches else []
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchmany(self, size=1):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class _Connection:
+    def __init__(self, warehouse):
+        self.warehouse = warehouse
+
+    def cursor(self):
+        return _Cursor(self.warehouse)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+PROMPT_TOKENS = [] # Estimated prompt size of every fake LLM call
+
+class FakeChatModel(SimpleChatModel):
+    """Deterministic chat model: answers from the prompt after sleeping for latency seconds"""
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "fake-benchmark"
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = "\n".join(str(message.content) for message in messages)
+        PROMPT_TOKENS.append(engine.estimate_tokens(prompt))
+        time.sleep(self.latency)
+        if "Entity Relationship" in prompt:
+            return "```mermaid\nerDiagram\n```"
+        if "quick analysis" in prompt:
+            return '```json\n{"generated_questions": ["How many rows are there per category?"]}\n```'
+        table = re.search(r"CREATE TABLE ([\w.]+)", prompt)
+        return f"```sql\nSELECT * FROM {table.group(1) if table else 'missing'} LIMIT 10\n```"
+
+def _fresh_caches(directory):
+    """Point the engine at empty on-disk caches and clear the in-memory ones"""
+    suffix = f"{time.monotonic_ns()}"
+    engine.set_metadata_cache(engine.MetadataCache(os.path.join(directory, f"metadata_{suffix}.sqlite")))
+    engine.set_llm_cache(engine.LLMResponseCache(os.path.join(directory, f"llm_{suffix}.sqlite")))
+    engine.set_result_cache(engine.ResultCache(os.path.join(directory, f"results_{suffix}")))
+    engine.set_sql_library(engine.SQLLibrary(os.path.join(directory, f"sql_library_{suffix}.sqlite")))
+    engine.set_catalog_index(engine.CatalogIndex())
+    engine._version_lookups.clear()
+    for function in (engine.database_context_for_llm, engine.describe_tables,
+                     engine.create_er_diagram, engine.create_sql, engine.generate_questions):
+        function.clear()
+    engine.schema_index.cache_clear()
+    engine.parse_schema_context.cache_clear()
+
+def _stages(tables, table_schema, question):
+    """Name -> (setup, run). setup runs untimed before every repeat"""
+    first_table = f"{CATALOG}.{SCHEMA}.{tables[0]}"
+    return {
+        'list_catalogs': (None, lambda: engine.list_catalogs()),
+        'list_schemas': (None, lambda: engine.list_schemas(CATALOG)),
+        'list_tables': (None, lambda: engine.list_tables(CATALOG, SCHEMA)),
+        'list_tables (index warm)': (lambda: engine.list_tables(CATALOG, SCHEMA), lambda: engine.list_tables(CATALOG, SCHEMA)),
+        'database_context_for_llm': (None, lambda: engine.database_context_for_llm(CATALOG, SCHEMA, tables)),
+        'database_context_for_llm (disk cache warm)': (lambda: engine.database_context_for_llm(CATALOG, SCHEMA, tables),
+                                                       lambda: (engine.database_context_for_llm.clear(), engine.database_context_for_llm(CATALOG, SCHEMA, tables))),
+        'create_er_diagram': (None, lambda: engine.create_er_diagram(CATALOG, SCHEMA, tables)),
+        'create_sql': (None, lambda: engine.create_sql(question, table_schema)),
+        'generate_valid_sql (3 candidates)': (None, lambda: engine.generate_valid_sql(question, table_schema, n_candidates=3)),
+        'validate_and_correct_sql (valid)': (None, lambda: engine.validate_and_correct_sql(question, f"SELECT * FROM {first_table} LIMIT 10", table_schema)),
+        'validate_and_correct_sql (invalid)': (None, lambda: engine.validate_and_correct_sql(question, f"SELECT no_such_column FROM {first_table}", table_schema)),
+    }
+
+def run_benchmark(sizes, repeats, llm_latency, directory):
+    engine.chat_model = lambda model="gpt-4o-mini", temperature=0.0: FakeChatModel(latency=llm_latency)
+    engine.get_llm_chain.cache_clear()
+    results = []
+    for size in sizes:
+        warehouse = SQLiteWarehouse(size)
+        engine.set_connection_pool(engine.DatabricksConnectionPool(connect=warehouse.connect))
+        _fresh_caches(directory)
+        table_schema = engine.database_context_for_llm(CATALOG, SCHEMA, warehouse.tables)
+        question = f"What is the average metric_0 per category_1 in {warehouse.tables[0]}?"
+
+        for name, (setup, run) in _stages(warehouse.tables, table_schema, question).items():
+            latencies, queries, tokens = [], 0, []
+            for repeat in range(repeats + 1): # The last repeat measures memory with tracemalloc
+                _fresh_caches(directory)
+                if setup: setup()
+                queries_before, tokens_before = warehouse.queries, len(PROMPT_TOKENS)
+                if repeat == repeats: tracemalloc.start()
+                start = time.perf_counter()
+                run()
+                elapsed = time.perf_counter() - start
+                if repeat == repeats:
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    break
+                latencies.append(elapsed)
+                queries += warehouse.queries - queries_before
+                tokens += PROMPT_TOKENS[tokens_before:]
+            results.append({'stage': name, 'tables': size, 'p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 2),
+                            'p95_ms': round(float(np.percentile(latencies, 95)) * 1000, 2), 'queries': queries / repeats,
+                            'llm_calls': len(tokens) / repeats, 'prompt_tokens_max': max(tokens, default=0),
+                            'peak_memory_mb': round(peak / 2**20, 2)})
+            print(f"{size:>6} tables | {name:<45} | p50 {results[-1]['p50_ms']:>10.2f} ms | p95 {results[-1]['p95_ms']:>10.2f} ms | "
+                  f"{results[-1]['queries']:>7.1f} queries | {results[-1]['llm_calls']:>4.1f} LLM calls | "
+                  f"{results[-1]['prompt_tokens_max']:>7} prompt tokens | {results[-1]['peak_memory_mb']:>8.2f} MB", file=sys.stderr)
+    return results
+
+def import_times(modules, repeats, top=5):
+    """Cold import time of each module in a fresh interpreter, from python -X importtime.
+    Each result also lists the slowest packages imported along the way"""
+    results = []
+    for module in modules:
+        latencies, packages = [], {}
+        for _ in range(repeats):
+            stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stderr
+            for line in stderr.splitlines():
+                fields = line.split("|")
+                if len(fields) != 3 or not fields[1].strip().isdigit(): continue
+                name, cumulative_us = fields[2].strip(), int(fields[1])
+                if name == module: latencies.append(cumulative_us / 1e6)
+                elif fields[2].startswith("   ") and not fields[2].startswith("     "): # Direct imports of the module
+                    packages[name] = max(packages.get(name, 0), cumulative_us / 1000)
+        slowest = sorted(packages.items(), key=lambda item: -item[1])[:top]
+        results.append({'stage': f"import {module}", 'tables': 0, 'p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 2),
+                        'p95_ms': round(float(np.percentile(latencies, 95)) * 1000, 2), 'slowest_imports_ms': dict(slowest)})
+        print(f"{'':>6}        | {results[-1]['stage']:<45} | p50 {results[-1]['p50_ms']:>10.2f} ms | p95 {results[-1]['p95_ms']:>10.2f} ms | "
+              f"slowest: {', '.join(f'{name} {ms:.0f} ms' for name, ms in slowest)}", file=sys.stderr)
+    return results
+
+def compare(results, baseline, tolerance):
+    """Stages whose p95 latency grew by more than the tolerance compared to the baseline"""
+    previous = {(result['stage'], result['tables']): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result['stage'], result['tables']))
+        if before and result['p95_ms'] > before['p95_ms'] * (1 + tolerance) + 1: # 1 ms of slack for timer noise
+            regressions.append(f"{result['stage']} ({result['tables']} tables): p95 {before['p95_ms']} -> {result['p95_ms']} ms")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the text-to-SQL pipeline offline")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[10, 100, 1000], help="Number of tables of the synthetic schemas")
+    parser.add_argument("--import-modules", nargs="*", default=["engine", "history"], help="Modules whose cold import time is measured")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds the fake LLM sleeps per call")
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--baseline", help="Results JSON of a previous run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed p95 slowdown against the baseline")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = import_times(args.import_modules, args.repeats) + run_benchmark(args.sizes, args.repeats, args.llm_latency, directory)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions: print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions: sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,101 +1,1052 @@
-from databricks import sql
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
-from langchain.chains.llm import LLMChain
-from langchain.output_parsers import ResponseSchema, StructuredOutputParser
-from langchain_core.prompts import PromptTemplate
-from langchain_openai import ChatOpenAI
-from yaml.loader import SafeLoader
 import numpy as np
-import os, sys
+import contextvars, functools, hashlib, json, logging, math, os, re, sqlite3, sys
+import threading, time
 import pandas as pd
 import streamlit as st
-import streamlit_authenticator as stauth
 import streamlit.components.v1 as components
 import sqlparse
-import yaml
 
 load_dotenv() # Get the environment variables. 
+logger = logging.getLogger("sqlgen")
 
-@st.experimental_fragment
-@st.cache_data
-def load_sample_from_databricks(query):
-    """Get a sample from databricks"""
-    con = sql.connect(server_hostname = os.getenv("DATABRICKS_SERVER_HOSTNAME"),
-                    http_path       = os.getenv("DATABRICKS_HTTP_PATH"),
-                    access_token    = os.getenv("DATABRICKS_ACCESS_TOKEN"))
-    if "LIMIT" not in query.upper():
-        query = query.replace(";","")
-        query += f" LIMIT 100;"
-    df = pd.read_sql(sql=query,con=con)
+class Span:
+    """A timed operation. Field names follow the OpenTelemetry span data model"""
+    __slots__ = ("name", "trace_id", "span_id", "parent", "start_ns", "end_ns", "attributes", "status")
+
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(16).hex()
+        self.span_id = os.urandom(8).hex()
+        self.start_ns, self.end_ns = time.time_ns(), None
+        self.attributes = attributes
+        self.status = "OK"
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def to_dict(self):
+        return {'name': self.name, 'trace_id': self.trace_id, 'span_id': self.span_id,
+                'parent_span_id': self.parent.span_id if self.parent is not None else None,
+                'start_time_unix_nano': self.start_ns, 'end_time_unix_nano': self.end_ns,
+                'duration_ms': round(self.duration_ms, 3), 'attributes': self.attributes, 'status': self.status}
+
+_current_span = contextvars.ContextVar("sqlgen_current_span", default=None)
+
+class Tracer:
+    """Records spans for warehouse queries, LLM calls and correction attempts.
+
+    Finished spans are kept in a bounded in-memory buffer (for the timing panel) and, when path is set,
+    appended to a local JSON lines file, one OpenTelemetry-style span per line. No collector is needed.
+    """
+
+    def __init__(self, path=None, max_spans=10000):
+        self.path = path
+        self.spans = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+        if path and os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def begin(self, name, root=False, **attributes):
+        """Start a span as a child of the current one (or a new trace when root) and make it current"""
+        span = Span(name, None if root else _current_span.get(), attributes)
+        _current_span.set(span)
+        return span
+
+    def end(self, span, error=None):
+        """Finish a span and make its parent current again"""
+        span.end_ns = time.time_ns()
+        if error is not None:
+            span.status = "ERROR"
+            span.attributes['error'] = str(error)[:1000]
+        if _current_span.get() is span: _current_span.set(span.parent)
+        with self._lock:
+            self.spans.append(span)
+            if self.path:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """Context manager recording a span around the block. Only exceptions mark it as an error: control flow
+        such as Streamlit reruns and stops or a closed generator (BaseException subclasses) ends it normally"""
+        span = self.begin(name, **attributes)
+        try:
+            yield span
+        except Exception as e:
+            self.end(span, e)
+            raise
+        except BaseException:
+            self.end(span)
+            raise
+        else:
+            self.end(span)
+
+    def trace(self, trace_id):
+        """Finished spans of one trace, in start order"""
+        with self._lock:
+            spans = [span for span in self.spans if span.trace_id == trace_id]
+        return sorted(spans, key=lambda span: span.start_ns)
+
+_tracer = None
+
+def get_tracer():
+    """Get the process-wide tracer. Spans are exported to SQLGEN_TRACE_PATH when it is set"""
+    global _tracer
+    if _tracer is None: _tracer = Tracer(os.getenv("SQLGEN_TRACE_PATH"))
+    return _tracer
+
+def with_current_span(fn):
+    """Wrap fn so it runs under the caller's current span when called from another thread"""
+    parent = _current_span.get()
+    def run(*args,**kwargs):
+        token = _current_span.set(parent)
+        try:
+            return fn(*args,**kwargs)
+        finally:
+            _current_span.reset(token)
+    return run
+
+def trace_summary(trace_id):
+    """Timing table of a trace: one row per span with its duration and attributes"""
+    return pd.DataFrame([{'span': span.name, 'duration_ms': round(span.duration_ms, 1), 'status': span.status,
+                          **{key: value for key, value in span.attributes.items() if key != 'statement'}}
+                         for span in get_tracer().trace(trace_id)])
+
+def read_sql(query,con):
+    """pd.read_sql recorded as a warehouse.query span"""
+    with get_tracer().span("warehouse.query", statement=query[:1000]) as span:
+        df = pd.read_sql(sql=query,con=con)
+        span.set(rows=len(df), bytes=int(df.memory_usage().sum()))
     return df
 
-@st.cache_data
-def user_query_history(user_name):
-    """Load the user history table"""
-    con = sql.connect(server_hostname = os.getenv("DATABRICKS_SERVER_HOSTNAME"),
+def _databricks_connect():
+    """Open a new connection to the Databricks SQL warehouse"""
+    from databricks import sql
+    return sql.connect(server_hostname = os.getenv("DATABRICKS_SERVER_HOSTNAME"),
                     http_path       = os.getenv("DATABRICKS_HTTP_PATH"),
                     access_token    = os.getenv("DATABRICKS_ACCESS_TOKEN"))
-    query = f"SELECT * FROM dev_tools.sqlgenpro_user_history WHERE user_name = {user_name} AND timestamp > current_date - 20"
-    df = pd.read_sql(sql=query,con=con)
+
+class DatabricksConnectionPool:
+    """Process-wide pool of reusable warehouse connections.
+
+    Connections are opened lazily up to max_size, handed back to the pool after use and closed once they
+    have been idle for longer than idle_timeout seconds. A connection that has been idle for more than
+    health_check_interval seconds is pinged before being reused and transparently replaced if the ping fails.
+    Any DBAPI compatible factory can be passed as connect, e.g. lambda: sqlite3.connect(":memory:", check_same_thread=False)
+    """
+
+    def __init__(self, connect=_databricks_connect, max_size=4, idle_timeout=300, health_check_interval=30,
+                 health_check_query="SELECT 1", acquire_timeout=60):
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.health_check_query = health_check_query
+        self.acquire_timeout = acquire_timeout
+        self._idle = [] # (connection, last used timestamp), most recently used last
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._stats = {'created': 0, 'reused': 0, 'closed': 0, 'evicted_idle': 0, 'failed_health_checks': 0,
+                       'discarded_on_error': 0, 'in_use': 0, 'idle': 0, 'wait_time_s': 0.0}
+
+    def _close(self, con):
+        try:
+            con.close()
+        except Exception:
+            pass
+        self._stats['closed'] += 1
+
+    def _evict_idle(self):
+        """Close connections that have been idle for too long. Must be called with the lock held"""
+        now = time.monotonic()
+        expired = [con for con, last_used in self._idle if now - last_used > self.idle_timeout]
+        self._idle = [(con, last_used) for con, last_used in self._idle if now - last_used <= self.idle_timeout]
+        for con in expired:
+            self._close(con)
+            self._stats['evicted_idle'] += 1
+
+    def _is_healthy(self, con):
+        try:
+            cursor = con.cursor()
+            try:
+                cursor.execute(self.health_check_query)
+                cursor.fetchall()
+            finally:
+                cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        """Borrow a connection from the pool, opening a new one if none is idle"""
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise TimeoutError(f"No warehouse connection available after {self.acquire_timeout}s (max_size={self.max_size})")
+        try:
+            while True:
+                with self._lock:
+                    self._evict_idle()
+                    con, last_used = self._idle.pop() if self._idle else (None, None)
+                if con is None:
+                    con = self.connect()
+                    with self._lock: self._stats['created'] += 1
+                    break
+                if time.monotonic() - last_used <= self.health_check_interval or self._is_healthy(con):
+                    with self._lock: self._stats['reused'] += 1
+                    break
+                with self._lock: self._stats['failed_health_checks'] += 1
+                self._close(con)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._stats['in_use'] += 1
+            self._stats['wait_time_s'] += time.monotonic() - start
+        return con
+
+    def release(self, con, discard=False):
+        """Return a borrowed connection. Broken connections are closed so the next caller reconnects"""
+        with self._lock:
+            self._stats['in_use'] -= 1
+            if discard:
+                self._stats['discarded_on_error'] += 1
+            else:
+                self._idle.append((con, time.monotonic()))
+            self._evict_idle()
+        if discard: self._close(con)
+        self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Context manager yielding a pooled connection. The connection is always returned, also when the block is
+        left by a BaseException such as a Streamlit rerun or stop (it is then discarded, a query may still be running)
+
+        >>> pool = DatabricksConnectionPool(connect=lambda: sqlite3.connect(":memory:", check_same_thread=False), max_size=1, acquire_timeout=1)
+        >>> with pool.connection(): raise SystemExit
+        Traceback (most recent call last):
+        SystemExit
+        >>> with pool.connection() as con: con.execute("SELECT 1").fetchall()
+        [(1,)]
+        >>> pool.stats()['in_use'], pool.stats()['discarded_on_error']
+        (0, 1)
+        """
+        con, discard = self.acquire(), True
+        try:
+            yield con
+            discard = False
+        except Exception:
+            # Errors raised by the query itself (bad SQL) leave the session usable
+            discard = not self._is_healthy(con)
+            raise
+        finally:
+            self.release(con, discard=discard)
+
+    def stats(self):
+        """Snapshot of the pool counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+        return stats
+
+    def close(self):
+        """Close every idle connection"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for con, _ in idle:
+            self._close(con)
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+def get_connection_pool():
+    """Get the process-wide connection pool, creating it on first use"""
+    global _connection_pool
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            _connection_pool = DatabricksConnectionPool(max_size=int(os.getenv("DATABRICKS_POOL_MAX_SIZE", 4)),
+                                                        idle_timeout=float(os.getenv("DATABRICKS_POOL_IDLE_TIMEOUT", 300)))
+        return _connection_pool
+
+def set_connection_pool(pool):
+    """Replace the process-wide connection pool (e.g. with one backed by a local sqlite/duckdb stand-in)"""
+    global _connection_pool
+    with _connection_pool_lock:
+        old_pool, _connection_pool = _connection_pool, pool
+    if old_pool is not None: old_pool.close()
+
+def databricks_connection():
+    """Borrow a connection from the process-wide pool"""
+    return get_connection_pool().connection()
+
+_singleton_lock = threading.RLock() # Guards the creation and replacement of the process-wide caches and services below
+
+@contextmanager
+def sqlite_connection(path):
+    """Connection to a local SQLite store that commits on success, rolls back on error and is always closed"""
+    con = sqlite3.connect(path, timeout=30)
+    try:
+        with con: yield con
+    finally:
+        con.close()
+
+def create_sqlite_store(path, *statements):
+    """Create the directory and tables of a local SQLite store, in WAL mode so readers do not block the writer"""
+    if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+    with sqlite_connection(path) as con:
+        con.execute("PRAGMA journal_mode=WAL")
+        for statement in statements: con.execute(statement)
+
+def evict_least_recently_used(con, table, max_entries):
+    """Keep the max_entries most recently used rows of a table with a last_access column"""
+    con.execute(f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} ORDER BY last_access DESC LIMIT -1 OFFSET ?)", (max_entries,))
+
+class MetadataCache:
+    """Persistent table metadata store shared by every session and worker on the host.
+
+    Entries live in a local SQLite file keyed by (catalog.schema.table, kind) and are only served while the
+    table version recorded with them still matches the warehouse and they are younger than ttl seconds.
+    The least recently used entries are evicted once more than max_entries are stored.
+    """
+
+    FORMAT_VERSION = 2 # Bump whenever the payload layout changes to drop incompatible entries
+
+    def __init__(self, path, ttl=7*24*3600, max_entries=5000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        create_sqlite_store(path, "CREATE TABLE IF NOT EXISTS cache_info (format_version INTEGER)",
+                            """CREATE TABLE IF NOT EXISTS table_metadata (table_key TEXT, kind TEXT, version TEXT, payload TEXT,
+                               created_at REAL, last_access REAL, PRIMARY KEY (table_key, kind))""",
+                            "CREATE INDEX IF NOT EXISTS table_metadata_last_access ON table_metadata (last_access)")
+        with self._connect() as con:
+            row = con.execute("SELECT format_version FROM cache_info").fetchone()
+            if row is None or row[0] != self.FORMAT_VERSION:
+                con.execute("DELETE FROM table_metadata")
+                con.execute("DELETE FROM cache_info")
+                con.execute("INSERT INTO cache_info VALUES (?)", (self.FORMAT_VERSION,))
+
+    def _connect(self):
+        return sqlite_connection(self.path)
+
+    def get(self, table_key, kind, version):
+        """Get the cached payload or None if it is missing, stale or was stored for another table version"""
+        now = time.time()
+        with self._lock, self._connect() as con:
+            row = con.execute("SELECT version, payload, created_at FROM table_metadata WHERE table_key = ? AND kind = ?",
+                              (table_key, kind)).fetchone()
+            if row is None: return None
+            if row[0] != (version or "") or now - row[2] > self.ttl:
+                con.execute("DELETE FROM table_metadata WHERE table_key = ? AND kind = ?", (table_key, kind))
+                return None
+            con.execute("UPDATE table_metadata SET last_access = ? WHERE table_key = ? AND kind = ?", (now, table_key, kind))
+        return json.loads(row[1])
+
+    def put(self, table_key, kind, version, payload):
+        """Store a JSON serialisable payload for the given table version"""
+        now = time.time()
+        with self._lock, self._connect() as con:
+            con.execute("INSERT OR REPLACE INTO table_metadata VALUES (?, ?, ?, ?, ?, ?)",
+                        (table_key, kind, version or "", json.dumps(payload), now, now))
+            evict_least_recently_used(con, "table_metadata", self.max_entries)
+
+    def invalidate(self, table_key=None):
+        """Drop the entries of one table, or everything"""
+        with self._lock, self._connect() as con:
+            if table_key is None: con.execute("DELETE FROM table_metadata")
+            else: con.execute("DELETE FROM table_metadata WHERE table_key = ?", (table_key,))
+
+_metadata_cache = None
+
+def get_metadata_cache():
+    """Get the on-disk metadata cache, creating it on first use"""
+    global _metadata_cache
+    with _singleton_lock:
+        if _metadata_cache is None:
+            _metadata_cache = MetadataCache(os.getenv("SQLGEN_METADATA_CACHE_PATH", os.path.join(".cache", "metadata.sqlite")),
+                                            ttl=float(os.getenv("SQLGEN_METADATA_CACHE_TTL", 7*24*3600)),
+                                            max_entries=int(os.getenv("SQLGEN_METADATA_CACHE_MAX_ENTRIES", 5000)))
+        return _metadata_cache
+
+def set_metadata_cache(cache):
+    """Replace the on-disk metadata cache (e.g. with one in a temporary directory)"""
+    global _metadata_cache
+    with _singleton_lock:
+        _metadata_cache = cache
+
+class ResultCache:
+    """On-disk cache of query results shared by every session and worker on the host.
+
+    Results are stored as zstd compressed Parquet files in directory, indexed in a SQLite file. Keys are built by
+    the caller from the normalised SQL and the versions of the tables it reads, so a changed table never serves an
+    old result. Entries expire after ttl seconds and the least recently used ones are evicted once the files take
+    more than max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=512*1024*1024, ttl=24*3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        create_sqlite_store(os.path.join(directory, "index.sqlite"),
+                            "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, bytes INTEGER, created_at REAL, last_access REAL)",
+                            "CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+
+    def _connect(self):
+        return sqlite_connection(os.path.join(self.directory, "index.sqlite"))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".parquet")
+
+    def _remove(self, con, key):
+        con.execute("DELETE FROM results WHERE key = ?", (key,))
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def get(self, key):
+        """Get the cached DataFrame or None"""
+        now = time.time()
+        with self._lock, self._connect() as con:
+            row = con.execute("SELECT created_at FROM results WHERE key = ?", (key,)).fetchone()
+            if row is not None and (now - row[0] > self.ttl or not os.path.exists(self._path(key))):
+                self._remove(con, key)
+                row = None
+            if row is None:
+                self._stats['misses'] += 1
+                return None
+            con.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+            self._stats['hits'] += 1
+        return pd.read_parquet(self._path(key))
+
+    def put(self, key, df):
+        """Store a DataFrame. Results that cannot be written as Parquet or are larger than the cache are skipped"""
+        temporary_path = self._path(key) + f".{threading.get_ident()}.tmp"
+        try:
+            df.to_parquet(temporary_path, compression="zstd", index=False)
+        except Exception as e:
+            logger.debug("Result not cached: %s", e)
+            if os.path.exists(temporary_path): os.remove(temporary_path)
+            return
+        size = os.path.getsize(temporary_path)
+        if size > self.max_bytes:
+            os.remove(temporary_path)
+            return
+        now = time.time()
+        with self._lock, self._connect() as con:
+            os.replace(temporary_path, self._path(key))
+            con.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, size, now, now))
+            self._stats['stores'] += 1
+            total = 0
+            for cached_key, cached_size in con.execute("SELECT key, bytes FROM results ORDER BY last_access DESC").fetchall():
+                total += cached_size
+                if total > self.max_bytes:
+                    self._remove(con, cached_key)
+                    self._stats['evictions'] += 1
+
+    def stats(self):
+        """Hits, misses, stores, evictions, entries and bytes"""
+        with self._lock, self._connect() as con:
+            entries, size = con.execute("SELECT count(*), coalesce(sum(bytes), 0) FROM results").fetchone()
+            return dict(self._stats, entries=entries, bytes=size)
+
+_result_cache = None
+
+def get_result_cache():
+    """Get the on-disk query result cache, creating it on first use"""
+    global _result_cache
+    with _singleton_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache(os.getenv("SQLGEN_RESULT_CACHE_PATH", os.path.join(".cache", "results")),
+                                        max_bytes=int(os.getenv("SQLGEN_RESULT_CACHE_MAX_BYTES", 512*1024*1024)),
+                                        ttl=float(os.getenv("SQLGEN_RESULT_CACHE_TTL", 24*3600)))
+        return _result_cache
+
+def set_result_cache(cache):
+    """Replace the on-disk query result cache (e.g. with one in a temporary directory)"""
+    global _result_cache
+    with _singleton_lock:
+        _result_cache = cache
+
+def normalise_sql(query):
+    """Canonical text of a query for cache keys: no comments, upper case keywords, single spaces outside string literals"""
+    text = sqlparse.format(query, strip_comments=True, keyword_case="upper").strip().rstrip(";").strip()
+    parts = re.split(r"('(?:[^'\\]|\\.)*')", text)
+    return "".join(part if i % 2 else re.sub(r"\s+", " ", part) for i, part in enumerate(parts))
+
+def referenced_tables(query):
+    """catalog.schema.table names the query reads from (schema qualified references only)"""
+    unquoted = re.sub(r"'(?:[^'\\]|\\.)*'", "''", sqlparse.format(query, strip_comments=True))
+    references = [match.group(1) for match in TABLE_REFERENCE.finditer(_without_function_arguments(unquoted))]
+    return sorted({reference.replace("`","").lower() for reference in references})
+
+_version_lookups = {} # catalog.schema.table -> (monotonic time, version)
+
+def unqualified_tables(query):
+    """Names the query reads from without a schema, other than its CTEs"""
+    unquoted = _without_function_arguments(re.sub(r"'(?:[^'\\]|\\.)*'", "''", sqlparse.format(query, strip_comments=True)))
+    ctes = {name.lower() for name in re.findall(r"(?:\bWITH(?:\s+RECURSIVE)?|,)\s*`?(\w+)`?\s+AS\s*\(", unquoted, re.I)}
+    names = {name.replace("`","").lower() for name in re.findall(r"\b(?:FROM|JOIN)\s+(`?\w+`?)(?![`\w]*\s*[.(])", unquoted, re.I)}
+    return sorted(names - ctes)
+
+def referenced_table_versions(query):
+    """Data versions (Delta commit) of the tables the query reads, remembered for SQLGEN_RESULT_VERSION_TTL seconds so a validation run
+    and the following sample fetch only look them up once. None when the result can not be keyed on table versions:
+    the query reads no catalog.schema.table, names a table without its catalog or a version is unknown"""
+    now, ttl = time.monotonic(), float(os.getenv("SQLGEN_RESULT_VERSION_TTL", 30))
+    references = referenced_tables(query)
+    if not references or unqualified_tables(query) or any(reference.count(".") != 2 for reference in references): return None
+    versions, missing = {}, {}
+    for reference in references:
+        cached = _version_lookups.get(reference)
+        if cached and now - cached[0] < ttl: versions[reference] = cached[1]
+        else: missing.setdefault(tuple(reference.split(".")[:2]),[]).append(reference.split(".")[2])
+    for (catalog, schema), tables_list in missing.items():
+        for table, version in table_data_versions(catalog,schema,tables_list).items():
+            versions[f"{catalog}.{schema}.{table}".lower()] = version
+            _version_lookups[f"{catalog}.{schema}.{table}".lower()] = (now, version)
+    if any(versions.get(reference) is None for reference in references): return None
+    return versions
+
+def result_limits():
+    """Row and byte caps applied to every result pulled into the app: (max rows, max bytes)"""
+    return int(os.getenv("SQLGEN_MAX_RESULT_ROWS", 100)), int(os.getenv("SQLGEN_MAX_RESULT_BYTES", 64*1024*1024))
+
+def limit_query(query,max_rows):
+    """Cap the rows returned by the outermost query. LIMITs inside CTEs and subqueries are left alone,
+    an outer LIMIT above max_rows is lowered and comments and trailing semicolons are stripped
+
+    >>> limit_query("SELECT * FROM t WHERE x = 1;", 100)
+    'SELECT * FROM t WHERE x = 1\\nLIMIT 100'
+    >>> limit_query("SELECT * FROM t WHERE x = 'a;b' LIMIT 500 ;", 100)
+    "SELECT * FROM t WHERE x = 'a;b' LIMIT 100"
+    """
+    # Trailing semicolons are removed from the text: sqlparse groups them into a trailing WHERE clause
+    query = re.sub(r"[\s;]+$", "", sqlparse.format(query, strip_comments=True))
+    statements = [statement for statement in sqlparse.parse(query) if str(statement).strip(" \n\t;")]
+    if len(statements) != 1: raise ValueError("Only a single SQL statement can be executed")
+    statement = statements[0]
+    tokens = list(statement.tokens)
+    while tokens and (tokens[-1].is_whitespace or tokens[-1].match(sqlparse.tokens.Punctuation, ";")): tokens.pop()
+    if statement.get_type() != "SELECT": return "".join(str(token) for token in tokens)
+
+    for index, token in enumerate(tokens):
+        if token.match(sqlparse.tokens.Keyword, "LIMIT"):
+            value = next((t for t in tokens[index+1:] if not t.is_whitespace), None)
+            if value is not None and value.ttype in sqlparse.tokens.Number.Integer and int(value.value) <= max_rows:
+                break
+            if value is not None: tokens[tokens.index(value)] = sqlparse.sql.Token(sqlparse.tokens.Number.Integer, str(max_rows))
+            break
+    else:
+        tokens.append(sqlparse.sql.Token(sqlparse.tokens.Whitespace, "\n"))
+        tokens.append(sqlparse.sql.Token(sqlparse.tokens.Keyword, f"LIMIT {max_rows}"))
+    return "".join(str(token) for token in tokens)
+
+def read_capped(query,con,max_bytes,chunksize=10000):
+    """Read a query into a DataFrame, stopping once max_bytes of data have been fetched.
+    df.attrs['truncated'] tells whether the result was cut short"""
+    chunks, size, truncated = [], 0, False
+    for chunk in pd.read_sql(sql=query,con=con,chunksize=chunksize):
+        chunk_size = int(chunk.memory_usage(deep=True).sum())
+        if size + chunk_size > max_bytes:
+            rows = int(len(chunk) * (max_bytes - size) / chunk_size) if chunk_size else 0
+            chunks.append(chunk.iloc[:rows])
+            truncated = True
+            break
+        chunks.append(chunk)
+        size += chunk_size
+    df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+    df.attrs['truncated'] = truncated
     return df
 
-@st.cache_data
-def catalog_schema_tables_tabletype():
-    """List all the catalog, schema and tables present in the database"""
-    with sql.connect(server_hostname=os.getenv("DATABRICKS_SERVER_HOSTNAME"),
-                      http_path=os.getenv("DATABRICKS_HTTP_PATH"),
-                      access_token=os.getenv("DATABRICKS_ACCESS_TOKEN")) as con:
-        with con.cursor() as cursor:
-            cursor.tables()
-            result_tables = cursor.fetchall()
-            df_catalog_schema_tables = pd.DataFrame(result_tables)
-            df_catalog_schema_tables = df_catalog_schema_tables.iloc[:,:4]
-            df_catalog_schema_tables.columns = ['catalog', 'schema', 'table', 'table_type']
-
-            return df_catalog_schema_tables
+def fetch_result(query,con,max_bytes,batch_size=10000,max_batches=None,on_batch=None):
+    """Fetch a query result as a stream of Arrow record batches and convert it to pandas once, without
+    going through Python row objects. on_batch is called with the first batch as a DataFrame so the UI can
+    render it while the rest is fetched. Fetching stops at max_bytes or max_batches.
+    df.attrs['fetch_stats'] holds rows, bytes, batches, seconds, rows_per_s and truncated.
+    Connections without Arrow support (e.g. sqlite) are read with pandas instead"""
+    start = time.monotonic()
+    cursor = con.cursor()
+    try:
+        if not hasattr(cursor, "fetchmany_arrow"):
+            df = read_capped(query,con,max_bytes,chunksize=batch_size)
+            stats = {'rows': len(df), 'bytes': int(df.memory_usage(deep=True).sum()), 'batches': 1, 'truncated': df.attrs['truncated']}
+            if on_batch is not None: on_batch(df)
+        else:
+            import pyarrow as pa
+
+            cursor.execute(query)
+            stats = {'rows': 0, 'bytes': 0, 'batches': 0, 'truncated': False}
+            batches, empty = [], None
+            while max_batches is None or stats['batches'] < max_batches:
+                batch = cursor.fetchmany_arrow(batch_size)
+                if batch.num_rows == 0:
+                    empty = batch
+                    break
+                if stats['bytes'] + batch.nbytes > max_bytes:
+                    batch = batch.slice(0, int(batch.num_rows * (max_bytes - stats['bytes']) / batch.nbytes))
+                    stats['truncated'] = True
+                batches.append(batch)
+                stats['rows'] += batch.num_rows
+                stats['bytes'] += batch.nbytes
+                stats['batches'] += 1
+                if stats['batches'] == 1 and on_batch is not None: on_batch(batch.to_pandas())
+                if stats['truncated']: break
+            else:
+                stats['truncated'] = True # Stopped at max_batches
+
+            table = pa.concat_tables(batches) if batches else empty
+            if table is None:
+                df = pd.DataFrame(columns=[column[0] for column in cursor.description or []])
+            else:
+                df = table.to_pandas(split_blocks=True, self_destruct=True) # Avoid consolidating into one copy per dtype
+                del table, batches
+    finally:
+        cursor.close()
+
+    stats['seconds'] = time.monotonic() - start
+    stats['rows_per_s'] = stats['rows'] / stats['seconds'] if stats['seconds'] else 0.0
+    df.attrs['fetch_stats'] = stats
+    df.attrs['truncated'] = stats['truncated']
+    return df
 
-@st.cache_data
-def database_context_for_llm(catalog,schema,tables_list):
-    """Create datbase schema details for the prompt"""
-    table_schema = ""
+class _FetchInterrupted(Exception):
+    """on_batch was interrupted, e.g. by a Streamlit rerun"""
+
+def load_sample_from_databricks(query,on_batch=None):
+    """Get a sample from databricks. SELECT results are served from the on-disk result cache while the tables
+    they read are unchanged, whatever the formatting of the query. Queries whose table versions are unknown always run.
+    On a cache miss the first Arrow batch is rendered through on_batch (e.g. st.empty().write) before the rest arrives"""
+    max_rows, max_bytes = result_limits()
+    query = limit_query(query,max_rows)
+    key = None
+    versions = referenced_table_versions(query) if sqlparse.parse(query)[0].get_type() == "SELECT" else None
+    if versions is not None:
+        with get_tracer().span("result_cache.get") as span:
+            key = hashlib.sha256(json.dumps([normalise_sql(query), max_rows, max_bytes, versions]).encode()).hexdigest()
+            df = get_result_cache().get(key)
+            span.set(cache_hit=df is not None)
+        if df is not None: return df
+    # Streamlit raises rerun and stop requests at UI calls such as on_batch. They are held until the fetch
+    # is abandoned and the connection is back in the pool, then raised again
+    interrupted = []
+    def render_first_batch(df):
+        try:
+            on_batch(df)
+        except BaseException as e:
+            interrupted.append(e)
+            raise _FetchInterrupted() from e
+
+    with get_tracer().span("warehouse.fetch", statement=query[:1000]) as span:
+        try:
+            with databricks_connection() as con:
+                df = fetch_result(query,con,max_bytes,max_batches=int(os.getenv("SQLGEN_MAX_RESULT_BATCHES", 100)),
+                                  on_batch=render_first_batch if on_batch is not None else None)
+        except _FetchInterrupted:
+            span.set(interrupted=True)
+        else:
+            span.set(**df.attrs['fetch_stats'])
+    if interrupted: raise interrupted[0]
+    if key is not None: get_result_cache().put(key,df)
+    return df
 
+class CatalogIndex:
+    """Catalog -> schema -> table index built lazily, one level at a time. A level is listed from the warehouse
+    only when it is first viewed and is kept for ttl seconds, so browsing never scans the whole metastore"""
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.index = {} # catalog -> schema -> sorted table names (None until the schema is opened)
+        self._loaded = {} # (), (catalog,) or (catalog, schema) -> monotonic time the level was listed
+        self._lock = threading.Lock()
+
+    def _fresh(self, level):
+        loaded_at = self._loaded.get(level)
+        return loaded_at is not None and time.monotonic() - loaded_at < self.ttl
+
+    def _list(self, method, column, **filters):
+        """Names from one filtered metadata call (cursor.catalogs/schemas/tables)"""
+        with databricks_connection() as con:
+            with con.cursor() as cursor:
+                with get_tracer().span("warehouse." + method, **filters) as span:
+                    getattr(cursor, method)(**filters)
+                    rows = cursor.fetchall()
+                    span.set(rows=len(rows))
+        return sorted({row[column] for row in rows})
+
+    def catalogs(self):
+        """Names of the catalogs"""
+        with self._lock:
+            if self._fresh(()): return list(self.index)
+        names = self._list("catalogs", 0)
+        with self._lock:
+            self.index = {catalog: self.index.get(catalog, {}) for catalog in names}
+            self._loaded[()] = time.monotonic()
+            return list(self.index)
+
+    def schemas(self, catalog):
+        """Names of the schemas in a catalog"""
+        with self._lock:
+            if self._fresh((catalog,)): return list(self.index[catalog])
+        names = self._list("schemas", 0, catalog_name=catalog)
+        with self._lock:
+            schemas = self.index.get(catalog, {})
+            self.index[catalog] = {schema: schemas.get(schema) for schema in names}
+            self._loaded[(catalog,)] = time.monotonic()
+            return list(self.index[catalog])
+
+    def tables(self, catalog, schema):
+        """Names of the tables in a schema"""
+        with self._lock:
+            if self._fresh((catalog, schema)): return list(self.index[catalog][schema])
+        names = self._list("tables", 2, catalog_name=catalog, schema_name=schema)
+        with self._lock:
+            self.index.setdefault(catalog, {})[schema] = names
+            self._loaded[(catalog, schema)] = time.monotonic()
+            return list(names)
+
+    def invalidate(self):
+        """Forget every level so the next lookup lists it again"""
+        with self._lock:
+            self.index, self._loaded = {}, {}
+
+_catalog_index = None
+
+def get_catalog_index():
+    """Get the process-wide catalog index, creating it on first use"""
+    global _catalog_index
+    with _singleton_lock:
+        if _catalog_index is None:
+            _catalog_index = CatalogIndex(ttl=float(os.getenv("SQLGEN_CATALOG_TTL", 3600)))
+        return _catalog_index
+
+def set_catalog_index(index):
+    """Replace the process-wide catalog index"""
+    global _catalog_index
+    with _singleton_lock:
+        _catalog_index = index
+
+def list_catalogs():
+    """List the catalogs present in the database"""
+    return get_catalog_index().catalogs()
+
+def list_schemas(catalog):
+    """List the schemas of a catalog"""
+    return get_catalog_index().schemas(catalog)
+
+def list_tables(catalog, schema):
+    """List the tables of a schema"""
+    return get_catalog_index().tables(catalog, schema)
+
+def _context_concurrency():
+    """Number of tables introspected concurrently. Each worker holds one pooled connection"""
+    return max(1, min(int(os.getenv("DATABRICKS_CONTEXT_CONCURRENCY", 8)), get_connection_pool().max_size))
+
+def _describe_table(catalog,schema,table):
+    """Get the (column, datatype) pairs of a single table"""
+    query = f"DESCRIBE TABLE `{catalog}`.{schema}.{table}"
+    with databricks_connection() as con:
+        df = read_sql(query,con)
+    # DESCRIBE appends partitioning details after an empty/'#' separator row
+    columns = []
+    for column, column_type in zip(df['col_name'].tolist(),df['data_type'].tolist()):
+        if not column or column.startswith('#'): break
+        columns.append((column,column_type))
+    return columns
+
+def _describe_tables_from_information_schema(catalog,schema,tables_list):
+    """Get the (column, datatype) pairs of several tables in a single round trip"""
+    tables_in = ", ".join(f"'{table}'" for table in tables_list)
+    query = f"""SELECT table_name, column_name, lower(data_type) AS data_type FROM `{catalog}`.information_schema.columns
+                WHERE table_schema = '{schema}' AND table_name IN ({tables_in}) ORDER BY table_name, ordinal_position"""
+    with databricks_connection() as con:
+        df = read_sql(query,con)
+    columns = {}
+    for table, column, column_type in df[['table_name','column_name','data_type']].itertuples(index=False):
+        columns.setdefault(table,[]).append((column,column_type))
+    return columns
+
+def _table_version(catalog,schema,table):
+    """Get the last modification time of a single table, or None if the warehouse does not report it"""
+    query = f"DESCRIBE DETAIL `{catalog}`.{schema}.{table}"
+    try:
+        with databricks_connection() as con:
+            df = read_sql(query,con)
+        return str(df['lastModified'][0])
+    except Exception:
+        return None
+
+def table_versions(catalog,schema,tables_list):
+    """Get a version marker (last modification time) for each table, used to invalidate the metadata cache"""
+    versions = {}
+    if catalog != "hive_metastore":
+        tables_in = ", ".join(f"'{table}'" for table in tables_list)
+        query = f"""SELECT table_name, CAST(last_altered AS STRING) AS version FROM `{catalog}`.information_schema.tables
+                    WHERE table_schema = '{schema}' AND table_name IN ({tables_in})"""
+        try:
+            with databricks_connection() as con:
+                df = read_sql(query,con)
+            versions = dict(zip(df['table_name'],df['version']))
+        except Exception:
+            versions = {}
+
+    missing = [table for table in tables_list if table not in versions]
+    if missing:
+        with ThreadPoolExecutor(max_workers=_context_concurrency()) as executor:
+            versions.update(zip(missing, executor.map(with_current_span(lambda table: _table_version(catalog,schema,table)), missing)))
+    return versions
+
+def _data_version(catalog,schema,table):
+    """Delta version of the last commit to a table, data or definition. Falls back to DESCRIBE DETAIL lastModified
+    for tables without a Delta history, or None"""
+    query = f"DESCRIBE HISTORY `{catalog}`.{schema}.{table} LIMIT 1"
+    try:
+        with databricks_connection() as con:
+            df = read_sql(query,con)
+        return f"delta:{df['version'][0]}"
+    except Exception:
+        return _table_version(catalog,schema,table)
+
+def table_data_versions(catalog,schema,tables_list):
+    """Get a version marker of the data of each table, used to key the result cache. information_schema's
+    last_altered only moves with the table definition, so a data-only commit would keep serving old results"""
+    with ThreadPoolExecutor(max_workers=_context_concurrency()) as executor:
+        return dict(zip(tables_list, executor.map(with_current_span(lambda table: _data_version(catalog,schema,table)), tables_list)))
+
+def _describe_tables(catalog,schema,tables_list,versions):
+    """Get the columns and datatypes of the tables, reading the on-disk metadata cache first"""
+    cache = get_metadata_cache()
+    columns = {}
     for table in tables_list:
-        con = sql.connect(server_hostname=os.getenv("DATABRICKS_SERVER_HOSTNAME"),
-                      http_path=os.getenv("DATABRICKS_HTTP_PATH"),
-                      access_token=os.getenv("DATABRICKS_ACCESS_TOKEN"))
-       
+        cached = cache.get(f"{catalog}.{schema}.{table}","columns",versions.get(table))
+        if cached is not None: columns[table] = [tuple(column) for column in cached]
+
+    missing = [table for table in tables_list if table not in columns]
+    if missing and catalog != "hive_metastore": # hive_metastore has no information_schema
+        try:
+            columns.update(_describe_tables_from_information_schema(catalog,schema,missing))
+        except Exception:
+            pass
+
+    # Fall back to DESCRIBE TABLE for anything information_schema did not return
+    describe = [table for table in missing if table not in columns]
+    if describe:
+        with ThreadPoolExecutor(max_workers=_context_concurrency()) as executor:
+            columns.update(zip(describe, executor.map(with_current_span(lambda table: _describe_table(catalog,schema,table)), describe)))
+
+    for table in missing:
+        cache.put(f"{catalog}.{schema}.{table}","columns",versions.get(table),columns[table])
+    return {table: columns[table] for table in tables_list}
+
+@st.cache_data
+def describe_tables(catalog,schema,tables_list):
+    """Get the columns and datatypes of the selected tables. Shared by the ERD and the prompt context"""
+    return _describe_tables(catalog,schema,tables_list,table_versions(catalog,schema,tables_list))
+
+def categorical_profile_settings():
+    """Categorical profiling configuration: (mode, max distinct values, sample percent)
+
+    mode "approx" (default) first estimates the distinct count of every string column with approx_count_distinct
+    on a TABLESAMPLE and only aggregates the values of the columns under the threshold. mode "exact" scans the full
+    table with COUNT(DISTINCT) for every string column.
+    """
+    return (os.getenv("SQLGEN_CATEGORICAL_MODE", "approx"),
+            int(os.getenv("SQLGEN_CATEGORICAL_THRESHOLD", 20)),
+            float(os.getenv("SQLGEN_CATEGORICAL_SAMPLE_PERCENT", 10)))
+
+def categorical_values(con,catalog,schema,table,string_cols,mode="approx",threshold=20,sample_percent=10):
+    """Get the distinct values of the categorical (at most threshold distinct values) string columns"""
+    table_name = f"`{catalog}`.{schema}.{table}"
+    candidates = string_cols
+    if mode == "approx":
+        # Cheap single-pass estimate. Distinct values in a sample never exceed those in the table,
+        # so anything above the threshold here is certainly not categorical
+        sample = f" TABLESAMPLE ({sample_percent} PERCENT)" if 0 < sample_percent < 100 else ""
+        query = "SELECT " + ", ".join(f"approx_count_distinct({col}) AS `{col}`" for col in string_cols) + f" FROM {table_name}{sample}"
+        df_estimates = read_sql(query,con)
+        candidates = [col for col in string_cols if df_estimates[col][0] <= threshold]
+        if not candidates: return pd.DataFrame(columns=['column_name','values'])
+
+    # The full table count is exact so a column just over the threshold is not kept with a truncated value list.
+    # Cap the aggregated values so a column that only looked categorical on the sample cannot blow up the result
+    sql_distinct = " UNION ALL ".join(f"SELECT '{col}' AS column_name, COUNT(DISTINCT {col}) AS cnt, slice(ARRAY_AGG(DISTINCT {col}), 1, {threshold}) AS values FROM {table_name}" for col in candidates)
+    df_categorical = read_sql(sql_distinct,con)
+    df_categorical = df_categorical[df_categorical['cnt'] <= threshold]
+    return df_categorical.drop(columns='cnt')
+
+@dataclass
+class Column:
+    """A table column and its datatype"""
+    __slots__ = ("name", "data_type")
+    name: str
+    data_type: str
+
+@dataclass
+class CategoricalValues:
+    """The distinct values of a categorical column"""
+    __slots__ = ("column", "values")
+    column: str
+    values: list
+
+@dataclass
+class Table:
+    """Everything the prompt needs to know about a table"""
+    __slots__ = ("catalog", "schema", "name", "version", "ddl", "columns", "sample_rows", "categorical")
+    catalog: str
+    schema: str
+    name: str
+    version: str
+    ddl: str
+    columns: list # of Column
+    sample_rows: str # Already rendered, sample rows are only ever used as prompt text
+    categorical: list # of CategoricalValues
+
+    def render(self):
+        """Prompt text for the table: DDL, sample rows and categorical values"""
+        if self.categorical:
+            categorical_fields = pd.DataFrame({'column_name': [values.column for values in self.categorical],
+                                               'values': [values.values for values in self.categorical]}).to_string(index=False)
+        else:
+            categorical_fields = "No Categorical Fields Found"
+        return self.ddl + "\n" + self.sample_rows + "\n\nCategorical Fields:\n" + categorical_fields + "\n"
+
+    def to_dict(self):
+        return {'catalog': self.catalog, 'schema': self.schema, 'name': self.name, 'version': self.version, 'ddl': self.ddl,
+                'columns': [[column.name, column.data_type] for column in self.columns], 'sample_rows': self.sample_rows,
+                'categorical': [[values.column, values.values] for values in self.categorical]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['catalog'], data['schema'], data['name'], data['version'], data['ddl'],
+                   [Column(*column) for column in data['columns']], data['sample_rows'],
+                   [CategoricalValues(*values) for values in data['categorical']])
+
+    @property
+    def fingerprint(self):
+        return hashlib.sha256(json.dumps(self.to_dict(), sort_keys=True).encode()).hexdigest()
+
+class SchemaContext:
+    """Structured schema of the selected tables. Renders the prompt text on demand and has a stable fingerprint,
+    so caches key on a 64 character digest instead of hashing the rendered text on every call. Known table
+    fingerprints (from the metadata cache or a pickled context) are reused instead of hashing the tables again"""
+    __slots__ = ("tables", "_fingerprints", "_fingerprint", "_text")
+
+    def __init__(self, tables, fingerprints=None):
+        self.tables = list(tables)
+        fingerprints = fingerprints or {}
+        self._fingerprints = {table.name: fingerprints.get(table.name) or table.fingerprint for table in self.tables}
+        self._fingerprint = None
+        self._text = None
+
+    @property
+    def fingerprint(self):
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.sha256("".join(self._fingerprints[table.name] for table in self.tables).encode()).hexdigest()
+        return self._fingerprint
+
+    def render(self):
+        """Prompt text of all the tables"""
+        if self._text is None: self._text = "\n".join(table.render() for table in self.tables)
+        return self._text
+
+    def to_json(self):
+        return json.dumps([table.to_dict() for table in self.tables])
+
+    @classmethod
+    def from_json(cls, text):
+        return cls([Table.from_dict(data) for data in json.loads(text)])
+
+    def __str__(self):
+        return self.render()
+
+    def __eq__(self, other):
+        return isinstance(other, SchemaContext) and self.fingerprint == other.fingerprint
+
+    def __hash__(self):
+        return hash(self.fingerprint)
+
+    def __getstate__(self):
+        # st.cache_data unpickles the context on every rerun, the fingerprints travel with it
+        return self.to_json(), self._fingerprints
+
+    def __setstate__(self, state):
+        text, fingerprints = state
+        self.__init__([Table.from_dict(data) for data in json.loads(text)], fingerprints)
+
+# st.cache_data hashes schema contexts by their fingerprint
+SCHEMA_HASH_FUNCS = {SchemaContext: lambda context: context.fingerprint}
+
+def schema_text(table_schema):
+    """Prompt text of a schema given either as text or as a SchemaContext"""
+    return table_schema.render() if isinstance(table_schema, SchemaContext) else table_schema
+
+def _json_value(value):
+    return None if value is None else value.item() if hasattr(value, "item") else str(value)
+
+def _table_context(catalog,schema,table,columns,version=None):
+    """Create the prompt details (DDL, sample rows and categorical values) for a single table"""
+    with databricks_connection() as con:
         # Get the Schema for the table
         query = f"SHOW CREATE TABLE `{catalog}`.{schema}.{table}"
-        df = pd.read_sql(sql=query,con=con)
+        df = read_sql(query,con)
         stmt = df['createtab_stmt'][0]
         stmt = stmt.split("USING")[0]
 
         # Get the string columns from the table to identify categorical columns
-        query = f"DESCRIBE TABLE `{catalog}`.{schema}.{table}"
-        df = pd.read_sql(sql=query,con=con)
-        string_cols = df[df['data_type']=='string']['col_name'].values.tolist()
+        string_cols = [column for column, column_type in columns if column_type == 'string']
 
         # Get the distinct values for each column as a row
-        sql_distinct = ""
-        for col in string_cols[:-1]:
-            sql_distinct += f"SELECT '{col}' AS column_name, COUNT(DISTINCT {col}) AS cnt, ARRAY_AGG(DISTINCT {col}) AS values FROM `{catalog}`.{schema}.{table} UNION ALL "
-        sql_distinct += f"SELECT '{string_cols[-1]}' AS column_name, COUNT(DISTINCT {string_cols[-1]}) AS cnt, ARRAY_AGG(DISTINCT {string_cols[-1]}) AS values FROM `{catalog}`.{schema}.{table}"
-
-        df_categorical = pd.read_sql(sql=sql_distinct,con=con)
-        df_categorical = df_categorical[df_categorical['cnt'] <= 20]
-        df_categorical.drop(columns='cnt',inplace=True)
-
-        if df_categorical.empty: df_categorical_fields = "No Categorical Fields Found"
-        else: df_categorical_fields = df_categorical.to_string(index=False)
+        categorical = []
+        if string_cols:
+            mode, threshold, sample_percent = categorical_profile_settings()
+            df_categorical = categorical_values(con,catalog,schema,table,string_cols,mode,threshold,sample_percent)
+            categorical = [CategoricalValues(column, [_json_value(value) for value in values])
+                           for column, values in df_categorical[['column_name','values']].itertuples(index=False)]
 
         # Get sample rows from the table
         query = f"SELECT * FROM `{catalog}`.{schema}.{table} LIMIT 3"
-        df = pd.read_sql(sql=query,con=con)
+        df = read_sql(query,con)
         samplle_rows = df.to_string(index=False)
 
-        if not table_schema: table_schema = stmt + "\n" + samplle_rows + "\n\nCategorical Fields:\n" + df_categorical_fields + "\n"
-        else: table_schema += "\n" + stmt + "\n" + samplle_rows + "\n\nCategorical Fields:\n" + df_categorical_fields + "\n"
+    return Table(catalog, schema, table, version, stmt, [Column(*column) for column in columns], samplle_rows, categorical)
 
+@st.cache_data
+def database_context_for_llm(catalog,schema,tables_list):
+    """Create datbase schema details for the prompt as a SchemaContext (str() gives the prompt text).
+    Tables are introspected concurrently and assembled in the given order"""
+    cache = get_metadata_cache()
+    versions = table_versions(catalog,schema,tables_list)
+    kind = "table:{}:{}:{}".format(*categorical_profile_settings()) # Profiling settings change the categorical values
+    tables, fingerprints = {}, {}
+    for table in tables_list:
+        cached = cache.get(f"{catalog}.{schema}.{table}",kind,versions.get(table))
+        if cached is not None:
+            tables[table] = Table.from_dict(cached)
+            fingerprints[table] = cached.get('fingerprint')
+
+    # Only introspect the tables that are unknown or have changed since they were cached
+    missing = [table for table in tables_list if table not in tables]
+    if missing:
+        columns = _describe_tables(catalog,schema,missing,versions)
+        with ThreadPoolExecutor(max_workers=_context_concurrency()) as executor:
+            tables.update(zip(missing, executor.map(with_current_span(lambda table: _table_context(catalog,schema,table,columns[table],versions.get(table))), missing)))
+        for table in missing:
+            # The fingerprint is stored with the table so unchanged tables are never hashed again
+            fingerprints[table] = tables[table].fingerprint
+            cache.put(f"{catalog}.{schema}.{table}",kind,versions.get(table),dict(tables[table].to_dict(),fingerprint=fingerprints[table]))
+
+    table_schema = SchemaContext((tables[table] for table in tables_list), {tables[table].name: fingerprints[table] for table in tables_list})
     return table_schema
 
 def process_llm_to_mermaid(response: str) -> str:
@@ -110,6 +1061,10 @@ def process_llm_to_sql(response: str) -> str:
     end = response.find('```',start)
     return response[start:end].strip()
 
+def extract_sql(response: str) -> str:
+    """Get the SQL from an LLM response, with or without a sql code block"""
+    return process_llm_to_sql(response) if "```sql" in response else response.strip()
+
 def mermaid(code: str) -> None:
     # Escaping backslashes for special characters in the code
     code_escaped = code.replace("\\", "\\\\").replace("`", "\\`")
@@ -130,57 +1085,399 @@ def mermaid(code: str) -> None:
     )
 
 
-@st.experimental_fragment
-@st.cache_data
-def create_er_diagram(catalog,schema,tables_list):
-    """Create the entity relationship diagram for the selected schenma and tables"""
-    table_schema = {}
-    con = sql.connect(server_hostname = os.getenv("DATABRICKS_SERVER_HOSTNAME"),
-                        http_path       = os.getenv("DATABRICKS_HTTP_PATH"),
-                        access_token    = os.getenv("DATABRICKS_ACCESS_TOKEN"))
-    #  Get the list of columns for each table
-    for table in tables_list:
-        query = f"DESCRIBE TABLE `{catalog}`.{schema}.{table}"
-        df = pd.read_sql(sql=query,con=con)
-        columns = df['col_name'].tolist()
-        columns_types = df['data_type'].tolist()
-        columns_list = [f"{column}:{column_type}" for column, column_type in zip(columns,columns_types)]
-        table_schema[table] = columns_list
-
-    #  Prompt Template
-    template_string = """
-    You are an expert in creating Entity Relationship Diagrams for databases. 
-    You need to generate the Mermaid code for the complete ERD diagram.
-    You are asked to create an ERD diagram that contains the tables and the columns present in the tables for the selected tables in the database.
-    Make sure the ERD is clear and easy to understand with proper relationships details.
+def normalise_question(question):
+    """Normalise a question for cache lookups: case, whitespace and trailing punctuation are ignored"""
+    return re.sub(r"\s+", " ", str(question)).strip().rstrip("?!. ").lower()
 
-    The selected tables in the database are given below (delimited //) in the dictionary format:
-    Keys being the table names and values being the list of columns and their datatype in the table. 
+def text_fingerprint(text):
+    """Stable fingerprint of a (schema) text that ignores whitespace differences"""
+    if isinstance(text, SchemaContext): return text.fingerprint
+    return hashlib.sha256(re.sub(r"\s+", " ", str(text)).strip().encode()).hexdigest()
 
-    //
-    {table_schema} 
-    //
+class LLMResponseCache:
+    """Persistent prompt/response cache for the LLM chains.
 
-    Valdate the mermaid code and verify that it is clear and correct.
-    Return the final mermaid code for the ERD diagram after proper analysis
+    Responses are keyed by the chain name, a fingerprint of every prompt input except the question (the scope)
+    and the normalised question. If an embed function is given, a question missing from the cache is also matched
+    against the questions already answered in the same scope and the closest one is served when its cosine
+    similarity reaches similarity_threshold. The least recently used entries are evicted beyond max_entries.
     """
 
-    prompt_template = PromptTemplate.from_template(template_string)
+    def __init__(self, path, max_entries=10000, embed=None, similarity_threshold=0.95):
+        self.path = path
+        self.max_entries = max_entries
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'semantic_hits': 0, 'misses': 0, 'stores': 0}
+        create_sqlite_store(path, """CREATE TABLE IF NOT EXISTS llm_responses (scope TEXT, question TEXT, embedding TEXT, response TEXT,
+                                     last_access REAL, PRIMARY KEY (scope, question))""",
+                            "CREATE INDEX IF NOT EXISTS llm_responses_last_access ON llm_responses (last_access)")
+
+    def _connect(self):
+        return sqlite_connection(self.path)
+
+    @staticmethod
+    def scope(chain_name, inputs, question_key="question"):
+        """Fingerprint of the chain and all inputs except the question"""
+        context = {key: text_fingerprint(value) for key, value in inputs.items() if key != question_key}
+        return hashlib.sha256(json.dumps([chain_name, context], sort_keys=True).encode()).hexdigest()
+
+    def _count(self, counter):
+        with self._lock: self._stats[counter] += 1
+
+    def get(self, scope, question):
+        """Get the cached response for the question, or None"""
+        question = normalise_question(question)
+        with self._connect() as con:
+            row = con.execute("SELECT response FROM llm_responses WHERE scope = ? AND question = ?", (scope, question)).fetchone()
+            if row is not None:
+                con.execute("UPDATE llm_responses SET last_access = ? WHERE scope = ? AND question = ?", (time.time(), scope, question))
+                self._count('hits')
+                return json.loads(row[0])
+
+            if self.embed is not None and question:
+                rows = con.execute("SELECT question, embedding, response FROM llm_responses WHERE scope = ? AND embedding IS NOT NULL", (scope,)).fetchall()
+                if rows:
+                    query_vector = np.asarray(self.embed(question), dtype=float)
+                    vectors = np.asarray([json.loads(embedding) for _, embedding, _ in rows], dtype=float)
+                    similarity = vectors @ query_vector / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector) + 1e-12)
+                    best = int(np.argmax(similarity))
+                    if similarity[best] >= self.similarity_threshold:
+                        con.execute("UPDATE llm_responses SET last_access = ? WHERE scope = ? AND question = ?", (time.time(), scope, rows[best][0]))
+                        self._count('semantic_hits')
+                        return json.loads(rows[best][2])
+        self._count('misses')
+        return None
+
+    def put(self, scope, question, response):
+        """Store a JSON serialisable response"""
+        question = normalise_question(question)
+        embedding = json.dumps(list(map(float, self.embed(question)))) if self.embed is not None and question else None
+        with self._connect() as con:
+            con.execute("INSERT OR REPLACE INTO llm_responses VALUES (?, ?, ?, ?, ?)", (scope, question, embedding, json.dumps(response), time.time()))
+            evict_least_recently_used(con, "llm_responses", self.max_entries)
+        self._count('stores')
+
+    def stats(self):
+        """Snapshot of the hit/miss counters"""
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['semantic_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['semantic_hits']) / lookups if lookups else 0.0
+        return stats
+
+_llm_cache = None
+
+def get_llm_cache():
+    """Get the persistent LLM response cache, creating it on first use.
+    Near-duplicate question matching is enabled by setting SQLGEN_LLM_CACHE_SIMILARITY (e.g. 0.95)"""
+    global _llm_cache
+    with _singleton_lock:
+        if _llm_cache is None:
+            embed, similarity = None, os.getenv("SQLGEN_LLM_CACHE_SIMILARITY")
+            if similarity:
+                from langchain_openai import OpenAIEmbeddings
+                embed = OpenAIEmbeddings(model="text-embedding-3-small").embed_query
+            _llm_cache = LLMResponseCache(os.getenv("SQLGEN_LLM_CACHE_PATH", os.path.join(".cache", "llm_responses.sqlite")),
+                                          max_entries=int(os.getenv("SQLGEN_LLM_CACHE_MAX_ENTRIES", 10000)),
+                                          embed=embed, similarity_threshold=float(similarity or 0.95))
+        return _llm_cache
+
+def set_llm_cache(cache):
+    """Replace the LLM response cache (e.g. with one in a temporary directory)"""
+    global _llm_cache
+    with _singleton_lock:
+        _llm_cache = cache
+
+def chat_model(model="gpt-4o-mini", temperature=0.0):
+    """Shared chat model per (model, temperature). langchain_openai is only imported on first use"""
+    return _chat_model(model, float(temperature))
+
+@functools.lru_cache(maxsize=None)
+def _chat_model(model, temperature):
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model=model, temperature=temperature)
+
+@functools.lru_cache(maxsize=None)
+def prompt_template(template_string):
+    """Parsed PromptTemplate of a template string, built once"""
+    from langchain_core.prompts import PromptTemplate
+    return PromptTemplate.from_template(template_string)
+
+@functools.lru_cache(maxsize=None)
+def structured_output_parser(response_schemas):
+    """StructuredOutputParser for a tuple of (name, description) response schemas, built once"""
+    from langchain.output_parsers import ResponseSchema, StructuredOutputParser
+    return StructuredOutputParser.from_response_schemas([ResponseSchema(name=name, description=description) for name, description in response_schemas])
+
+@functools.lru_cache(maxsize=None)
+def get_llm_chain(template_string, temperature=0.0, response_schemas=()):
+    """Shared LLMChain for a prompt template, temperature and optional structured output, built once per process"""
+    from langchain.chains.llm import LLMChain
+    kwargs = {'output_parser': structured_output_parser(response_schemas)} if response_schemas else {}
+    return LLMChain(llm=chat_model(temperature=temperature), prompt=prompt_template(template_string), **kwargs)
+
+def invoke_llm_chain(chain_name,llm_chain,inputs,question_key="question",refresh=False):
+    """Invoke an LLMChain through the persistent response cache, with the prompt fitted to the token budget.
+    refresh skips the cached response and replaces it, for explicit regenerate actions"""
+    inputs = fit_prompt_to_budget(chain_name,llm_chain.prompt,inputs)
+    cache = get_llm_cache()
+    scope = cache.scope(chain_name,inputs,question_key)
+    question = inputs.get(question_key,"")
+    with get_tracer().span(f"llm.{chain_name}", chain=chain_name) as span:
+        response = None if refresh else cache.get(scope,question)
+        span.set(cache_hit=response is not None)
+        if response is None:
+            span.set(prompt_tokens=count_tokens(llm_chain.prompt.format(**inputs)))
+            response = llm_chain.invoke(inputs)
+            response = {key: value for key, value in response.items() if key not in inputs} # Drop the echoed inputs
+            span.set(completion_tokens=count_tokens(json.dumps(response, default=str)))
+            cache.put(scope,question,response)
+    return response
 
-    llm_chain = LLMChain(llm=ChatOpenAI(model="gpt-4o-mini",temperature=0),prompt=prompt_template)
+_background_executor = None
+
+def background_executor():
+    """Process-wide executor for LLM and warehouse work that should not block the Streamlit script thread"""
+    global _background_executor
+    with _singleton_lock:
+        if _background_executor is None:
+            _background_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SQLGEN_BACKGROUND_WORKERS", 8)), thread_name_prefix="sqlgen")
+        return _background_executor
+
+def submit_background(fn,*args,**kwargs):
+    """Run fn on the background executor. The caller's Streamlit script context is attached to the
+    worker thread so st.cache_data keeps working there, and spans recorded by fn nest under the caller's span"""
+    fn = with_current_span(fn)
+    ctx = None
+    try:
+        from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+        ctx = get_script_run_ctx()
+    except ImportError:
+        pass
+
+    def run():
+        if ctx is not None: add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args,**kwargs)
+    return background_executor().submit(run)
+
+def _chain_future(future,fn):
+    """Future of fn(future.result()), submitted once future completes, without blocking a worker while waiting"""
+    chained = Future()
+    fn = with_current_span(fn)
+    def on_done(done):
+        try:
+            inner = submit_background(fn,done.result())
+        except Exception as e:
+            chained.set_exception(e)
+            return
+        inner.add_done_callback(lambda result: chained.set_exception(result.exception()) if result.exception() else chained.set_result(result.result()))
+    future.add_done_callback(on_done)
+    return chained
+
+def table_constraints(catalog,schema,tables_list):
+    """Get the declared keys of the tables: ({table: [primary key columns]}, [(table, column, referenced table, referenced column)]).
+    Empty when the catalog has no information_schema or declares no constraints"""
+    if catalog == "hive_metastore" or not tables_list: return {}, []
+    tables_in = ", ".join(f"'{table}'" for table in tables_list)
+    primary_keys_query = f"""SELECT kcu.table_name, kcu.column_name FROM `{catalog}`.information_schema.table_constraints tc
+                JOIN `{catalog}`.information_schema.key_column_usage kcu
+                  ON kcu.constraint_schema = tc.constraint_schema AND kcu.constraint_name = tc.constraint_name
+                WHERE tc.constraint_type = 'PRIMARY KEY' AND tc.table_schema = '{schema}' AND tc.table_name IN ({tables_in})
+                ORDER BY kcu.table_name, kcu.ordinal_position"""
+    foreign_keys_query = f"""SELECT fk.table_name, fk.column_name, pk.table_name AS referenced_table, pk.column_name AS referenced_column
+                FROM `{catalog}`.information_schema.referential_constraints rc
+                JOIN `{catalog}`.information_schema.key_column_usage fk
+                  ON fk.constraint_schema = rc.constraint_schema AND fk.constraint_name = rc.constraint_name
+                JOIN `{catalog}`.information_schema.key_column_usage pk
+                  ON pk.constraint_catalog = rc.unique_constraint_catalog AND pk.constraint_schema = rc.unique_constraint_schema
+                 AND pk.constraint_name = rc.unique_constraint_name AND pk.ordinal_position = fk.position_in_unique_constraint
+                WHERE fk.table_schema = '{schema}' AND fk.table_name IN ({tables_in})"""
+    try:
+        with databricks_connection() as con:
+            df_primary_keys = read_sql(primary_keys_query,con)
+            df_foreign_keys = read_sql(foreign_keys_query,con)
+    except Exception:
+        return {}, []
+    primary_keys = {}
+    for table, column in df_primary_keys[['table_name','column_name']].itertuples(index=False):
+        primary_keys.setdefault(table,[]).append(column)
+    return primary_keys, [tuple(row) for row in df_foreign_keys[['table_name','column_name','referenced_table','referenced_column']].itertuples(index=False)]
+
+@dataclass
+class Relationship:
+    """A many-to-one link from table.column to referenced_table.referenced_column"""
+    __slots__ = ("table", "column", "referenced_table", "referenced_column", "source")
+    table: str
+    column: str
+    referenced_table: str
+    referenced_column: str
+    source: str # foreign_key (declared), naming (inferred from the column name), ambiguous (one of several candidates) or llm
+
+def _entity_keys(table):
+    """Names a `<name>_id` column may use for a table: orders -> order, dim_customers -> customer, categories -> category"""
+    name = table.lower()
+    names = {name}
+    for prefix in ("dim_", "fact_", "fct_", "tbl_", "stg_"):
+        if name.startswith(prefix): names.add(name[len(prefix):])
+    for candidate in list(names):
+        if candidate.endswith("ies") and len(candidate) > 4: names.add(candidate[:-3] + "y")
+        elif candidate.endswith(("ses", "xes", "ches", "shes")): names.add(candidate[:-2])
+        elif candidate.endswith("s") and not candidate.endswith("ss"): names.add(candidate[:-1])
+    return names
+
+def infer_relationships(table_columns,primary_keys=None,foreign_keys=()):
+    """Relationships between the tables: the declared foreign keys, plus `<table>_id` columns that name another table.
+    A column naming several tables (e.g. customers and dim_customer) gives one ambiguous relationship per candidate"""
+    primary_keys = primary_keys or {}
+    relationships = [Relationship(*foreign_key,"foreign_key") for foreign_key in foreign_keys
+                     if foreign_key[0] in table_columns and foreign_key[2] in table_columns]
+    declared = {(relationship.table, relationship.column) for relationship in relationships}
+
+    tables_by_key = {}
+    for table in table_columns:
+        for key in _entity_keys(table): tables_by_key.setdefault(key,[]).append(table)
+    column_names = {table: {column.lower(): column for column, _ in columns} for table, columns in table_columns.items()}
+
+    for table, columns in table_columns.items():
+        for column, _ in columns:
+            name = column.lower()
+            if (table, column) in declared or not name.endswith("_id") or len(name) <= 3: continue
+            candidates = []
+            for referenced_table in tables_by_key.get(name[:-3], []):
+                referenced_names = column_names[referenced_table]
+                own_key = primary_keys.get(referenced_table, [None])[0]
+                referenced_column = (own_key if own_key and len(primary_keys[referenced_table]) == 1 else
+                                     referenced_names.get("id") or referenced_names.get(name))
+                if referenced_column and not (referenced_table == table and referenced_column == column):
+                    candidates.append((referenced_table, referenced_column))
+            source = "naming" if len(candidates) == 1 else "ambiguous"
+            relationships += [Relationship(table,column,referenced_table,referenced_column,source) for referenced_table, referenced_column in candidates]
+    return relationships
+
+def resolve_relationships_with_llm(relationships,table_columns,refresh=False):
+    """Ask the LLM which candidate each ambiguous column refers to. Other relationships are returned unchanged"""
+    ambiguous = {}
+    for relationship in relationships:
+        if relationship.source == "ambiguous":
+            ambiguous.setdefault(f"{relationship.table}.{relationship.column}",[]).append(relationship.referenced_table)
+    if not ambiguous: return relationships
+
+    response_schemas = (("relationships", 'JSON object mapping each "table.column" to the table it references, or "none"'),)
+    template_string = """
+    Each column below (delimited by //) could reference any of several candidate tables. Using the table columns, decide which table
+    each column references, or none of them.
 
-    response = llm_chain.invoke({'table_schema':table_schema})
-    output = response['text']
-    return output
+    //
+    {ambiguous}
+    //
+
+    Table columns:
+    {tables}
 
+    {format_instructions}
+    """
+    tables = {table for candidates in ambiguous.values() for table in candidates} | {key.split(".")[0] for key in ambiguous}
+    llm_chain = get_llm_chain(template_string,response_schemas=response_schemas)
+    try:
+        response = invoke_llm_chain('resolve_relationships',llm_chain,
+                                    {'ambiguous': "\n".join(f"{column}: {', '.join(candidates)}" for column, candidates in ambiguous.items()),
+                                     'tables': "\n".join(f"{table}: {', '.join(column for column, _ in table_columns[table])}" for table in sorted(tables)),
+                                     'format_instructions': structured_output_parser(response_schemas).get_format_instructions()},
+                                    refresh=refresh)
+        choices = response['text']['relationships']
+        if isinstance(choices, str): choices = json.loads(choices)
+    except Exception:
+        logger.warning("Could not resolve the ambiguous ERD relationships with the LLM", exc_info=True)
+        return relationships
+
+    resolved = []
+    for relationship in relationships:
+        if relationship.source != "ambiguous":
+            resolved.append(relationship)
+        elif choices.get(f"{relationship.table}.{relationship.column}") == relationship.referenced_table:
+            resolved.append(Relationship(relationship.table,relationship.column,relationship.referenced_table,relationship.referenced_column,"llm"))
+    return resolved
+
+def erd_partitions(tables_list,relationships,max_tables):
+    """Split the tables into groups of at most max_tables, keeping related tables together where possible.
+    Connected groups are split breadth first, so each part stays readable; small groups are packed together"""
+    neighbours = {table: set() for table in tables_list}
+    for relationship in relationships:
+        neighbours[relationship.table].add(relationship.referenced_table)
+        neighbours[relationship.referenced_table].add(relationship.table)
+
+    components, seen = [], set()
+    for table in sorted(tables_list, key=lambda table: (-len(neighbours[table]), table)): # Start from the hubs
+        if table in seen: continue
+        component, queue = [], deque([table])
+        seen.add(table)
+        while queue:
+            current = queue.popleft()
+            component.append(current)
+            for neighbour in sorted(neighbours[current] - seen):
+                seen.add(neighbour)
+                queue.append(neighbour)
+        components.append(component)
+
+    partitions = []
+    for component in sorted(components, key=len, reverse=True):
+        for start in range(0, len(component), max_tables):
+            chunk = component[start:start+max_tables]
+            fitting = next((partition for partition in partitions if len(partition) + len(chunk) <= max_tables), None)
+            if fitting is None: partitions.append(list(chunk))
+            else: fitting.extend(chunk)
+    return partitions
+
+def _mermaid_name(name):
+    """Mermaid ER identifiers only allow letters, digits, underscores and hyphens"""
+    return re.sub(r"[^A-Za-z0-9_-]+", "_", str(name)).strip("_") or "_"
+
+def erd_mermaid(table_columns,relationships,primary_keys=None,tables_list=None):
+    """Mermaid erDiagram code for the tables. Declared foreign keys are solid lines, inferred ones dotted"""
+    primary_keys = primary_keys or {}
+    tables_list = list(table_columns) if tables_list is None else tables_list
+    included = set(tables_list)
+    foreign_keys = {(relationship.table, relationship.column) for relationship in relationships}
+    lines = ["erDiagram"]
+    for table in tables_list:
+        lines.append(f"    {_mermaid_name(table)} {{")
+        for column, column_type in table_columns[table]:
+            keys = ",".join(key for key, present in (("PK", column in primary_keys.get(table, ())), ("FK", (table, column) in foreign_keys)) if present)
+            lines.append(f"        {_mermaid_name(column_type)} {_mermaid_name(column)}{' ' + keys if keys else ''}")
+        lines.append("    }")
+    for relationship in relationships:
+        if relationship.table not in included or relationship.referenced_table not in included: continue
+        line = "--" if relationship.source == "foreign_key" else ".."
+        label = relationship.column + ("?" if relationship.source == "ambiguous" else "")
+        lines.append(f'    {_mermaid_name(relationship.referenced_table)} ||{line}o{{ {_mermaid_name(relationship.table)} : "{label}"')
+    return "\n".join(lines)
 
-@st.experimental_fragment
 @st.cache_data
-def generate_questions(table_schema):
-    """Generate questions based on the given schema and tables"""
-    output_schema = ResponseSchema(name="generated_questions",description="Generated questions for the given tables list")
-    output_parser = StructuredOutputParser.from_response_schemas([output_schema])
-    format_instructions = output_parser.get_format_instructions()
+def create_er_diagram(catalog,schema,tables_list,refresh=False):
+    """Create the entity relationship diagrams (Mermaid code) for the selected schema and tables, built from the metadata.
+    Large selections are split into several diagrams of at most SQLGEN_ERD_MAX_TABLES tables. With SQLGEN_ERD_LLM=1
+    the LLM picks the referenced table of columns matching several tables, asked again when refresh is set"""
+    table_columns = describe_tables(catalog,schema,tables_list)
+    table_columns = {table: table_columns[table] for table in tables_list if table in table_columns}
+    primary_keys, foreign_keys = table_constraints(catalog,schema,list(table_columns))
+    with get_tracer().span("erd.build", tables=len(table_columns)) as span:
+        relationships = infer_relationships(table_columns,primary_keys,foreign_keys)
+        if os.getenv("SQLGEN_ERD_LLM", "0") == "1":
+            relationships = resolve_relationships_with_llm(relationships,table_columns,refresh)
+        max_tables = int(os.getenv("SQLGEN_ERD_MAX_TABLES", 40))
+        diagrams = [erd_mermaid(table_columns,relationships,primary_keys,partition)
+                    for partition in erd_partitions(list(table_columns),relationships,max_tables)]
+        span.set(relationships=len(relationships), diagrams=len(diagrams))
+    return diagrams
+
+
+@st.cache_data(hash_funcs=SCHEMA_HASH_FUNCS)
+def generate_questions(table_schema,refresh=False):
+    """Generate questions based on the given schema and tables. refresh asks the LLM again instead of using the cached response"""
+    response_schemas = (("generated_questions", "Generated questions for the given tables list"),)
+    format_instructions = structured_output_parser(response_schemas).get_format_instructions()
 
     # Prompt Template
     template_string = """
@@ -197,20 +1494,167 @@ def generate_questions(table_schema):
     {format_instructions}
     """
 
-    prompt_template = PromptTemplate.from_template(template_string)
+    llm_chain = get_llm_chain(template_string,response_schemas=response_schemas)
 
-    llm_chain = LLMChain(llm=ChatOpenAI(model='gpt-4o-mini',temperature=0),prompt=prompt_template,output_parser=output_parser)
-
-    response = llm_chain.invoke({'table_schema':table_schema,'format_instructions':format_instructions})
+    response = invoke_llm_chain('generate_questions',llm_chain,{'table_schema':schema_text(table_schema),'format_instructions':format_instructions},refresh=refresh)
 
     return response
 
-@st.experimental_fragment
-@st.cache_data
-def create_sql(question,table_schema):
-    """Create SQL code for the selected question and return the data from the database"""
-    # Prompt Template
-    template_string = """
+def _search_terms(text):
+    """Lowercase terms for lexical matching. snake_case identifiers also yield their parts and plurals their singular"""
+    terms = []
+    for word in re.findall(r"[a-z0-9_]+", str(text).lower()):
+        parts = [word] + ([part for part in word.split("_") if part] if "_" in word else [])
+        terms += [part[:-1] if len(part) > 3 and part.endswith("s") else part for part in parts]
+    return terms
+
+class SchemaIndex:
+    """BM25 index over the per-table blocks of the prompt schema (DDL, sample rows and categorical values).
+
+    prune() keeps the top_k tables most relevant to a question plus the tables that join two of them
+    (found from <table>_id naming), so the prompt only carries what the question needs.
+    """
+
+    def __init__(self, table_schema, k1=1.5, b=0.75):
+        self.table_schema = table_schema
+        self.k1, self.b = k1, b
+        starts = [match.start() for match in re.finditer(r"^\s*CREATE\s+(?:OR\s+REPLACE\s+)?(?:TABLE|VIEW)\s", table_schema, re.I | re.M)]
+        self.blocks = {}
+        for start, end in zip(starts, starts[1:] + [len(table_schema)]):
+            name = re.match(r"\s*CREATE\s+(?:OR\s+REPLACE\s+)?(?:TABLE|VIEW)\s+([`\w.]+)", table_schema[start:end], re.I).group(1)
+            self.blocks[name.replace("`","").split(".")[-1].lower()] = table_schema[start:end].strip("\n")
+        self.documents = {table: Counter(_search_terms(table + " " + block)) for table, block in self.blocks.items()}
+        self.average_length = sum(sum(terms.values()) for terms in self.documents.values()) / max(len(self.documents), 1)
+        self.document_frequency = Counter(term for terms in self.documents.values() for term in terms)
+
+        # table -> tables it references through <table>_id style columns
+        columns = {table: details['columns'] for table, details in parse_schema_context(table_schema).items()}
+        self.references = {table: {other for other in self.blocks if other != table and
+                                   {f"{other}_id", f"{other.rstrip('s')}_id"} & columns.get(table, set())}
+                           for table in self.blocks}
+
+    def search(self, text):
+        """Tables ranked by BM25 relevance to the text"""
+        scores = {}
+        for table, terms in self.documents.items():
+            length = sum(terms.values())
+            score = 0.0
+            for term in set(_search_terms(text)):
+                if term not in terms: continue
+                idf = math.log(1 + (len(self.documents) - self.document_frequency[term] + 0.5) / (self.document_frequency[term] + 0.5))
+                score += idf * terms[term] * (self.k1 + 1) / (terms[term] + self.k1 * (1 - self.b + self.b * length / self.average_length))
+            scores[table] = score
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+    def prune(self, text, top_k=5, required=()):
+        """Compact schema text for the question: returns (schema text, report with the kept tables and token counts)"""
+        ranked = [table for table, score in self.search(text) if score > 0][:top_k]
+        selected = set(ranked) | {table for table in required if table in self.blocks}
+        if not selected: selected = set(self.blocks) # Nothing matched, keep everything rather than guess
+
+        # Keep the tables that join two of the selected tables
+        for table in set(self.blocks) - selected:
+            linked = {other for other in self.blocks if table in self.references[other]} | self.references[table]
+            if len(linked & selected) >= 2: selected.add(table)
+
+        pruned = "\n\n".join(block for table, block in self.blocks.items() if table in selected)
+        report = {'tables': [table for table in self.blocks if table in selected], 'tables_before': len(self.blocks),
+                  'tokens_before': estimate_tokens(self.table_schema), 'tokens_after': estimate_tokens(pruned)}
+        return pruned, report
+
+@functools.lru_cache(maxsize=16)
+def schema_index(table_schema):
+    """Index of the prompt schema, built once per schema text"""
+    return SchemaIndex(table_schema)
+
+def prune_schema_context(text,table_schema,sql_code=""):
+    """Keep only the tables relevant to the text (question, SQL, error) plus any table the SQL already uses.
+    Disabled when SQLGEN_SCHEMA_TOP_K is 0 or the schema has no more tables than that"""
+    top_k = int(os.getenv("SQLGEN_SCHEMA_TOP_K", 5))
+    index = schema_index(table_schema)
+    if top_k <= 0 or len(index.blocks) <= top_k: return table_schema
+
+    required = [table for table in index.blocks if re.search(rf"\b{re.escape(table)}\b", sql_code, re.I)]
+    pruned, report = index.prune(text + " " + sql_code, top_k, required)
+    logger.info("Schema pruned to %s of %s tables (%s -> %s tokens): %s", len(report['tables']), report['tables_before'],
+                report['tokens_before'], report['tokens_after'], ", ".join(report['tables']))
+    return pruned
+
+def compact_schema_text(table_schema,sample_rows=True,max_values=None):
+    """Smaller prompt schema: without the sample rows, with at most max_values values per categorical column
+    (0 drops the categorical values altogether)"""
+    starts = [match.start() for match in re.finditer(r"^\s*CREATE\s+(?:OR\s+REPLACE\s+)?(?:TABLE|VIEW)\s", table_schema, re.I | re.M)]
+    if not starts: return table_schema
+    blocks = [table_schema[:starts[0]]]
+    for start, end in zip(starts, starts[1:] + [len(table_schema)]):
+        block = table_schema[start:end]
+        # The DDL ends with the bracket closing the column definitions
+        depth, position = 0, block.find("(")
+        while 0 <= position < len(block):
+            depth += {"(": 1, ")": -1}.get(block[position], 0)
+            position += 1
+            if depth == 0: break
+        ddl = block[:position] if position > 0 else block
+        marker = block.find("Categorical Fields:")
+        categorical = block[marker:] if marker >= 0 else ""
+        middle = block[len(ddl):marker if marker >= 0 else len(block)]
+
+        if max_values == 0:
+            categorical = ""
+        elif max_values is not None and categorical:
+            lines = []
+            for line in categorical.splitlines():
+                values = re.match(r"(\s*\w+\s+)\[(.*)\]\s*$", line)
+                if values:
+                    items = re.findall(r"'(?:[^'\\]|\\.)*'", values.group(2)) or [item.strip() for item in _split_top_level(values.group(2))]
+                    if len(items) > max_values:
+                        line = f"{values.group(1)}[{', '.join(items[:max_values])}, ... ({len(items) - max_values} more)]"
+                lines.append(line)
+            categorical = "\n".join(lines) + "\n"
+        blocks.append(ddl + (middle if sample_rows else "\n\n") + categorical)
+    return "".join(blocks)
+
+def shorten_error(error_msg,max_tokens=500):
+    """Error message without JVM/Python stack frames, cut to its first and last lines when still over max_tokens"""
+    lines = [line for line in str(error_msg).splitlines()
+             if not re.match(r"\s*(at [\w$.<>]+\(.*\)|\.\.\. \d+ more|File \".*\", line \d+)", line)]
+    text = "\n".join(lines)
+    if count_tokens(text) <= max_tokens: return text
+    characters = max_tokens * 2 # Keep about max_tokens/2 tokens from each end
+    return text[:characters] + "\n... (error message shortened) ...\n" + text[-characters:]
+
+PROMPT_COMPACTION_STEPS = [ # (description, input, compaction), applied in order until the prompt fits the budget
+    ("drop sample rows", 'table_schema', lambda text: compact_schema_text(text, sample_rows=False)),
+    ("shorten error message", 'error_msg', shorten_error),
+    ("truncate categorical values", 'table_schema', lambda text: compact_schema_text(text, sample_rows=False, max_values=10)),
+    ("drop categorical values", 'table_schema', lambda text: compact_schema_text(text, sample_rows=False, max_values=0)),
+]
+
+def fit_prompt_to_budget(chain_name,prompt,inputs,budget=None):
+    """Measure the prompt of a chain (a PromptTemplate and its inputs) and compact the schema and the error message
+    step by step while it is over SQLGEN_PROMPT_TOKEN_BUDGET tokens. Logs the tokens of each section and returns
+    the inputs to use"""
+    budget = budget or int(os.getenv("SQLGEN_PROMPT_TOKEN_BUDGET", 16000))
+    inputs = dict(inputs)
+    sections = {'template': count_tokens(prompt.format(**{key: "" for key in inputs}))}
+    sections.update({key: count_tokens(value) for key, value in inputs.items()})
+    applied = []
+    for description, key, compact in PROMPT_COMPACTION_STEPS:
+        if sum(sections.values()) <= budget: break
+        if key not in inputs: continue
+        compacted = compact(str(inputs[key]))
+        if compacted == inputs[key]: continue
+        inputs[key] = compacted
+        sections[key] = count_tokens(compacted)
+        applied.append(description)
+
+    total = sum(sections.values())
+    log = logger.warning if total > budget else logger.info
+    log("Prompt %s: %s tokens of %s (%s)%s", chain_name, total, budget, ", ".join(f"{key} {tokens}" for key, tokens in sections.items()),
+        f", compacted: {', '.join(applied)}" if applied else "")
+    return inputs
+
+CREATE_SQL_TEMPLATE = """
     (delimited by //)
     Your are an expert data engineer working with a Databricks environment. You are asked to generate a working SQL query in Databricks SQL.
     During join if column name are same please use alias ex schema.id in select statement. 
@@ -234,17 +1678,53 @@ def create_sql(question,table_schema):
     OUTPUT:
     """
 
-    prompt_template = PromptTemplate.from_template(template_string)
+def start_schema_tasks(catalog,schema,tables_list):
+    """Start the ERD, the schema context and (once the context is ready) the suggested questions concurrently.
+    Returns a dict of futures: erd, table_schema and questions"""
+    erd = submit_background(create_er_diagram,catalog,schema,tables_list)
+    table_schema = submit_background(database_context_for_llm,catalog,schema,tables_list)
+    questions = _chain_future(table_schema,generate_questions)
+    return {'erd': erd, 'table_schema': table_schema, 'questions': questions}
 
-    llm_chain = LLMChain(llm=ChatOpenAI(model='gpt-4o-mini',temperature=0),prompt=prompt_template)
+@st.cache_data(hash_funcs=SCHEMA_HASH_FUNCS)
+def create_sql(question,table_schema):
+    """Create SQL code for the selected question and return the data from the database"""
+    table_schema = prune_schema_context(question,schema_text(table_schema))
+    llm_chain = get_llm_chain(CREATE_SQL_TEMPLATE)
 
-    response = llm_chain.invoke({'question':question,'table_schema':table_schema})
+    response = invoke_llm_chain('create_sql',llm_chain,{'question':question,'table_schema':table_schema})
     output = response['text']
 
     return output
 
-@st.experimental_fragment
-@st.cache_data
+def stream_create_sql(question,table_schema):
+    """Same as create_sql but yields the response tokens as they are generated (for st.write_stream).
+    Cached responses are yielded at once and streamed responses are added to the cache"""
+    inputs = {'question':question,'table_schema':prune_schema_context(question,schema_text(table_schema))}
+    inputs = fit_prompt_to_budget('create_sql',prompt_template(CREATE_SQL_TEMPLATE),inputs)
+    cache = get_llm_cache()
+    scope = cache.scope('create_sql',inputs)
+    response = cache.get(scope,question)
+    if response is not None:
+        yield response['text']
+        return
+
+    prompt = prompt_template(CREATE_SQL_TEMPLATE).format(**inputs)
+    chunks = []
+    span = get_tracer().begin("llm.create_sql", chain='create_sql', cache_hit=False, streaming=True, prompt_tokens=count_tokens(prompt))
+    try:
+        for chunk in chat_model().stream(prompt):
+            if not chunks: span.set(time_to_first_token_ms=round(span.duration_ms, 1))
+            chunks.append(chunk.content)
+            yield chunk.content
+    except BaseException as e:
+        get_tracer().end(span, e)
+        raise
+    span.set(completion_tokens=count_tokens("".join(chunks)))
+    get_tracer().end(span)
+    cache.put(scope,question,{'text': "".join(chunks)})
+
+@st.cache_data(hash_funcs=SCHEMA_HASH_FUNCS)
 def create_advanced_sql(question,sql_code,table_schema):
     """Create SQL code for the selected question and return the data from the database"""
     template_string = """
@@ -271,26 +1751,156 @@ def create_advanced_sql(question,sql_code,table_schema):
     OUTPUT:
     """
 
-    prompt_template = PromptTemplate.from_template(template_string)
-    llm_chain = LLMChain(llm=ChatOpenAI(model='gpt-4o-mini',temperature=0),prompt=prompt_template)
+    llm_chain = get_llm_chain(template_string)
 
-    response = llm_chain.invoke({'sql_code':sql_code,'question':question,'table_schema':table_schema})
+    table_schema = prune_schema_context(question,schema_text(table_schema),sql_code)
+    response = invoke_llm_chain('create_advanced_sql',llm_chain,{'sql_code':sql_code,'question':question,'table_schema':table_schema})
     output = response['text']
 
     return output
 
-@st.experimental_fragment
-def error_check(query):
-    """Validate if sellf-correction is needed for the generated SQL query"""
+def _split_top_level(text, separator=","):
+    """Split on separators that are not nested in brackets"""
+    parts, depth, current = [], 0, ""
+    for char in text:
+        if char in "(<[": depth += 1
+        elif char in ")>]": depth -= 1
+        if char == separator and depth == 0:
+            parts.append(current)
+            current = ""
+        else:
+            current += char
+    return parts + [current]
+
+def _without_function_arguments(sql_text):
+    """The SQL with the arguments of function calls blanked out (positions are kept) and subqueries left alone,
+    so FROM in EXTRACT(YEAR FROM o.order_date) or TRIM(BOTH ' ' FROM o.status) is not taken for a table reference"""
+    chars, stack = list(sql_text), [] # One entry per open bracket: does it hold a subquery
+    for position, char in enumerate(sql_text):
+        if char == "(":
+            stack.append(re.match(r"\s*(?:SELECT|WITH)\b", sql_text[position+1:], re.I) is not None)
+        elif char == ")":
+            if stack: stack.pop()
+        elif stack and not stack[-1]:
+            chars[position] = " "
+    return "".join(chars)
+
+TABLE_REFERENCE = re.compile(r"\b(?:FROM|JOIN)\s+([`\w]+(?:\.[`\w]+)+)(?:\s+(?:AS\s+)?`?(\w+)`?)?", re.I)
+
+def _parse_categorical_values(text):
+    """Parse a rendered list of values: [a, b] (python list) or ['a' 'b'] (numpy array)"""
+    quoted = re.findall(r"'((?:[^'\\]|\\.)*)'", text)
+    return set(quoted) if quoted else {value.strip() for value in text.split(",") if value.strip()}
+
+@functools.lru_cache(maxsize=32)
+def parse_schema_context(table_schema):
+    """Extract the tables, their columns and categorical values from the prompt schema (text or SchemaContext)"""
+    if isinstance(table_schema, SchemaContext):
+        return {table.name.lower(): {'columns': {column.name.lower() for column in table.columns},
+                                     'categorical': {values.column.lower(): {str(value) for value in values.values} for values in table.categorical}}
+                for table in table_schema.tables}
+    tables = {}
+    creates = list(re.finditer(r"CREATE\s+(?:OR\s+REPLACE\s+)?(?:TABLE|VIEW)\s+([`\w.]+)\s*\(", table_schema, re.I))
+    for index, create in enumerate(creates):
+        # Find the closing bracket of the column definitions
+        depth, position = 1, create.end()
+        while position < len(table_schema) and depth:
+            depth += {"(": 1, ")": -1}.get(table_schema[position], 0)
+            position += 1
+        columns = set()
+        for definition in _split_top_level(table_schema[create.end():position-1]):
+            column = re.match(r"\s*`?(\w+)`?", definition)
+            if column and column.group(1).upper() not in ("CONSTRAINT", "PRIMARY", "FOREIGN"): columns.add(column.group(1).lower())
+
+        categorical = {}
+        section_end = creates[index+1].start() if index+1 < len(creates) else len(table_schema)
+        section = table_schema[position:section_end].split("Categorical Fields:", 1)
+        if len(section) == 2:
+            for line in section[1].splitlines():
+                values = re.match(r"\s*(\w+)\s+\[(.*)\]\s*$", line)
+                if values: categorical[values.group(1).lower()] = _parse_categorical_values(values.group(2))
+        tables[create.group(1).replace("`","").split(".")[-1].lower()] = {'columns': columns, 'categorical': categorical}
+    return tables
+
+_NOT_ALIASES = {"ON", "USING", "WHERE", "GROUP", "ORDER", "LIMIT", "JOIN", "INNER", "LEFT", "RIGHT", "FULL", "CROSS", "OUTER",
+                "NATURAL", "UNION", "EXCEPT", "INTERSECT", "HAVING", "WINDOW", "QUALIFY", "LATERAL", "PIVOT", "UNPIVOT", "TABLESAMPLE"}
+
+def local_sql_errors(query,table_schema):
+    """Find errors in the query without touching the warehouse: unbalanced brackets, unknown tables,
+    unknown columns of known tables and values that do not exist in categorical columns"""
+    statements = [statement for statement in sqlparse.parse(query) if str(statement).strip(" \n\t;")]
+    if not statements: return ["The SQL query is empty"]
+    if len(statements) > 1: return ["Only a single SQL statement is allowed"]
+
+    sql_text = sqlparse.format(query, strip_comments=True)
+    unquoted = re.sub(r"'(?:[^'\\]|\\.)*'", "''", sql_text)
+    if unquoted.count("(") != unquoted.count(")"): return ["Unbalanced parentheses in the SQL query"]
+
+    tables = parse_schema_context(table_schema) if table_schema else {}
+    if not tables: return []
+
+    # Only schema qualified references outside function arguments are checked. Unqualified names may be CTEs
+    errors, aliases = [], {}
+    references = list(TABLE_REFERENCE.finditer(_without_function_arguments(unquoted)))
+    for reference, alias in (match.groups() for match in references):
+        table = reference.replace("`","").split(".")[-1].lower()
+        if table not in tables:
+            errors.append(f"Table or view not found: {reference}")
+            continue
+        aliases[table] = table
+        if alias and alias.upper() not in _NOT_ALIASES: aliases[alias.lower()] = table
+
+    without_references = unquoted
+    for match in reversed(references): # Blank the table names, keeping the positions of the other references
+        without_references = without_references[:match.start(1)] + " " * (match.end(1) - match.start(1)) + without_references[match.end(1):]
+    for qualifier, column in set(re.findall(r"\b`?(\w+)`?\.`?(\w+)`?", without_references)):
+        table = aliases.get(qualifier.lower())
+        if table and tables[table]['columns'] and column.lower() not in tables[table]['columns']:
+            errors.append(f"Column {qualifier}.{column} does not exist in table {table}. Available columns: {', '.join(sorted(tables[table]['columns']))}")
+
+    # Literal comparisons against categorical columns of the referenced tables
+    comparisons = [(qualifier, column, [value]) for qualifier, column, value in re.findall(r"(?:\b(\w+)\.)?\b(\w+)\s*(?:=|!=|<>)\s*'([^']*)'", sql_text)]
+    comparisons += [(qualifier, column, re.findall(r"'([^']*)'", values)) for qualifier, column, values in re.findall(r"(?:\b(\w+)\.)?\b(\w+)\s+(?:NOT\s+)?IN\s*\(([^)]*)\)", sql_text, re.I)]
+    for qualifier, column, values in comparisons:
+        candidates = [aliases[qualifier.lower()]] if qualifier.lower() in aliases else set(aliases.values())
+        valid = set().union(*[tables[table]['categorical'].get(column.lower(), set()) for table in candidates])
+        for value in values:
+            if valid and value not in valid:
+                errors.append(f"'{value}' is not a valid value of the categorical column {column}. Valid values: {sorted(valid)}")
+    return errors
+
+def explain_sql(query):
+    """Let the warehouse analyse the query with EXPLAIN, which compiles it without reading any data"""
     try:
-        df = load_sample_from_databricks(query)
-        error_msg = "Successful"
+        with databricks_connection() as con:
+            df = read_sql("EXPLAIN " + query.strip().rstrip(";"),con)
     except Exception as e:
-        error_msg = str(e)
+        return str(e)
+    plan = "\n".join(df.iloc[:,0].astype(str).tolist())
+    if "Error occurred during query planning" in plan or "AnalysisException" in plan: return plan.strip()
+    return "Successful"
+
+def validate_sql(query,table_schema=None,execute=False):
+    """Tiered validation: local parse and schema checks, then EXPLAIN, then (only if requested) a real LIMIT 100 run"""
+    errors = local_sql_errors(query,table_schema)
+    if errors: return "\n".join(errors)
+
+    error_msg = explain_sql(query)
+    if error_msg != "Successful" or not execute: return error_msg
+
+    try:
+        load_sample_from_databricks(query)
+    except Exception as e:
+        return str(e)
+    return "Successful"
+
+def error_check(query,table_schema=None,execute=None):
+    """Validate if sellf-correction is needed for the generated SQL query"""
+    if execute is None: execute = os.getenv("SQLGEN_VALIDATION_EXECUTE", "0") == "1"
+    error_msg = validate_sql(query,table_schema,execute)
 
     return error_msg
 
-@st.experimental_fragment
 def correct_sql(question,sql_code,table_schema,error_msg):
     """Validate and self-correct generated SQL query"""
     # Promp Template
@@ -317,18 +1927,17 @@ def correct_sql(question,sql_code,table_schema,error_msg):
     OUTPUT:
     """
 
-    prompt_template = PromptTemplate.from_template(template_string)
-
-    llm_chain = LLMChain(llm=ChatOpenAI(model='gpt-4o-mini',temperature=0),prompt=prompt_template)
+    llm_chain = get_llm_chain(template_string)
 
-    response = llm_chain.invoke({'question':question,'sql_code':sql_code,'table_schema':table_schema,'error_msg':error_msg})
+    table_schema = prune_schema_context(question + " " + error_msg,schema_text(table_schema),sql_code)
+    response = invoke_llm_chain('correct_sql',llm_chain,{'question':question,'sql_code':sql_code,'table_schema':table_schema,'error_msg':error_msg})
     output = response['text']
 
     return output
 
 def validate_and_correct_sql(question,query,table_schema):
     """Validate and self-correct"""
-    error_msg = error_check(query)
+    error_msg = error_check(query,table_schema)
 
     if error_msg == "Successful": 
         return "Successful",query
@@ -336,39 +1945,314 @@ def validate_and_correct_sql(question,query,table_schema):
         modified_query = correct_sql(question,query,table_schema,error_msg)
         return "Incorrect", modified_query
 
-@st.experimental_fragment
-def add_to_user_history(user_name,question,query,favourite_ind):
-    """Add the selected question to the user history"""
-    con = sql.connect(server_hostname = os.getenv("DATABRICKS_SERVER_HOSTNAME"),
-                    http_path       = os.getenv("DATABRICKS_HTTP_PATH"),
-                    access_token    = os.getenv("DATABRICKS_ACCESS_TOKEN"))
-    
-    user_history_table = "hive_metastore.dev_tools.user_query_history"
-
-    query = f"""INSERT INTO {user_history_table} VALUES ('{user_name}',current_timestamp(),'{question}',"{query}",{favourite_ind})"""
-    df = pd.read_sql(sql=query,con=con)
-
-def get_user_history_questions(user_name):
-    """"Get user's favourite questions"""
-    con = sql.connect(server_hostname = os.getenv("DATABRICKS_SERVER_HOSTNAME"),
-                    http_path       = os.getenv("DATABRICKS_HTTP_PATH"),
-                    access_token    = os.getenv("DATABRICKS_ACCESS_TOKEN"))
-    
-    user_history_table = "hive_metastore.dev_tools.user_query_history"
+class SQLLibrary:
+    """Shared library of validated SQL per question, used by every user and session on the host.
 
-    query = f"""SELECT question FROM {user_history_table} WHERE user_name='{user_name}';"""
-    df = pd.read_sql(sql=query, con = con)
-    return df
-
-def delete_question_from_user_history(user_name, question_to_delete):
-    """Delete the question from the user's favourites"""
-    con = sql.connect(server_hostname = os.getenv("DATABRICKS_SERVER_HOSTNAME"),
-                    http_path       = os.getenv("DATABRICKS_HTTP_PATH"),
-                    access_token    = os.getenv("DATABRICKS_ACCESS_TOKEN"))
-    
-    user_history_table = "hive_metastore.dev_tools.user_query_history"
-
-    query = f"""DELETE FROM {user_history_table} WHERE question = '{question_to_delete}' and user_name = '{user_name}'; """
-    df = pd.read_sql(sql=query, con=con)
+    Entries are keyed by a fingerprint of the catalogs/schemas the question was asked on (the scope) and the
+    normalised question, so exact and normalised matches are both served. Each entry records whether its SQL
+    validated the last time it was checked, when that was and when it last succeeded. Entries last checked more
+    than revalidate_after seconds ago are still served and revalidated in the background.
+    """
 
-    
\ No newline at end of file
+    def __init__(self, path, revalidate_after=24*3600, max_entries=50000):
+        self.path = path
+        self.revalidate_after = revalidate_after
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._revalidating = set()
+        self._stats = {'hits': 0, 'misses': 0, 'stores': 0, 'revalidations': 0}
+        create_sqlite_store(path, """CREATE TABLE IF NOT EXISTS validated_sql (scope TEXT, question_key TEXT, question TEXT, sql TEXT, status TEXT,
+                                     last_validated REAL, last_success REAL, hits INTEGER, last_access REAL, PRIMARY KEY (scope, question_key))""",
+                            "CREATE INDEX IF NOT EXISTS validated_sql_last_access ON validated_sql (last_access)")
+
+    def _connect(self):
+        return sqlite_connection(self.path)
+
+    def get(self, scope, question):
+        """The entry for the question (dict of question, sql, status, last_validated, last_success) or None"""
+        now = time.time()
+        with self._lock, self._connect() as con:
+            row = con.execute("""SELECT question, sql, status, last_validated, last_success FROM validated_sql
+                                 WHERE scope = ? AND question_key = ?""", (scope, normalise_question(question))).fetchone()
+            if row is None:
+                self._stats['misses'] += 1
+                return None
+            con.execute("UPDATE validated_sql SET hits = hits + 1, last_access = ? WHERE scope = ? AND question_key = ?",
+                        (now, scope, normalise_question(question)))
+            self._stats['hits'] += 1
+        return dict(zip(('question', 'sql', 'status', 'last_validated', 'last_success'), row))
+
+    def put(self, scope, question, sql_code, valid):
+        """Record the outcome of validating sql_code for the question"""
+        now = time.time()
+        with self._lock, self._connect() as con:
+            con.execute("""INSERT INTO validated_sql VALUES (?, ?, ?, ?, ?, ?, ?, 0, ?)
+                           ON CONFLICT (scope, question_key) DO UPDATE SET question = excluded.question, sql = excluded.sql,
+                           status = excluded.status, last_validated = excluded.last_validated,
+                           last_success = coalesce(excluded.last_success, validated_sql.last_success), last_access = excluded.last_access""",
+                        (scope, normalise_question(question), question, sql_code, "valid" if valid else "invalid", now,
+                         now if valid else None, now))
+            evict_least_recently_used(con, "validated_sql", self.max_entries)
+            self._stats['stores'] += 1
+
+    def revalidate_in_background(self, scope, question, sql_code):
+        """Check a stale entry again on the background executor, once at a time per entry.
+        Only EXPLAIN is used: the scope spans every table selection, so the current prompt schema may not list the tables the SQL reads"""
+        key = (scope, normalise_question(question))
+        with self._lock:
+            if key in self._revalidating: return
+            self._revalidating.add(key)
+            self._stats['revalidations'] += 1
+
+        def revalidate():
+            try:
+                self.put(scope, question, sql_code, error_check(sql_code,None) == "Successful")
+            finally:
+                with self._lock: self._revalidating.discard(key)
+        submit_background(revalidate)
+
+    def stats(self):
+        """Hits, misses, stores, background revalidations and entries"""
+        with self._lock, self._connect() as con:
+            return dict(self._stats, entries=con.execute("SELECT count(*) FROM validated_sql").fetchone()[0])
+
+_sql_library = None
+
+def get_sql_library():
+    """Get the shared SQL library, creating it on first use"""
+    global _sql_library
+    with _singleton_lock:
+        if _sql_library is None:
+            _sql_library = SQLLibrary(os.getenv("SQLGEN_SQL_LIBRARY_PATH", os.path.join(".cache", "sql_library.sqlite")),
+                                      revalidate_after=float(os.getenv("SQLGEN_SQL_LIBRARY_REVALIDATE_AFTER", 24*3600)),
+                                      max_entries=int(os.getenv("SQLGEN_SQL_LIBRARY_MAX_ENTRIES", 50000)))
+        return _sql_library
+
+def set_sql_library(library):
+    """Replace the shared SQL library (e.g. with one in a temporary directory)"""
+    global _sql_library
+    with _singleton_lock:
+        _sql_library = library
+
+def schema_scope(table_schema):
+    """Fingerprint of the catalogs/schemas a prompt schema covers, the same for every table selection within them"""
+    if isinstance(table_schema, SchemaContext):
+        names = {f"{table.catalog}.{table.schema}".lower() for table in table_schema.tables}
+    else:
+        names = {".".join(name.replace("`","").lower().split(".")[:-1])
+                 for name in re.findall(r"CREATE\s+(?:OR\s+REPLACE\s+)?(?:TABLE|VIEW)\s+([`\w.]+)", str(table_schema), re.I)}
+    return hashlib.sha256(json.dumps(sorted(names)).encode()).hexdigest()
+
+def validated_sql(question,table_schema):
+    """SQL from the library that validated for the question, or None. Stale entries are served and revalidated in the background"""
+    library, scope = get_sql_library(), schema_scope(table_schema)
+    with get_tracer().span("sql_library.get") as span:
+        entry = library.get(scope,question)
+        span.set(hit=entry is not None and entry['status'] == "valid")
+    if entry is None or entry['status'] != "valid": return None
+    if time.time() - entry['last_validated'] > library.revalidate_after:
+        library.revalidate_in_background(scope,question,entry['sql'])
+    return entry['sql']
+
+def remember_sql(question,table_schema,correction):
+    """Add the outcome of generating SQL for the question to the library. Only successes replace an entry"""
+    if correction.successful:
+        get_sql_library().put(schema_scope(table_schema),question,correction.sql,True)
+
+def estimate_tokens(text):
+    """Rough token count (about 4 characters per token)"""
+    return len(str(text)) // 4 + 1
+
+@functools.lru_cache(maxsize=1)
+def _token_encoding():
+    """tiktoken encoding of the chat models (SQLGEN_TOKEN_ENCODING), or None when tiktoken or its data is unavailable"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(os.getenv("SQLGEN_TOKEN_ENCODING", "o200k_base"))
+    except Exception as e:
+        logger.info("Token counts are estimated, tiktoken is not available: %s", e)
+        return None
+
+def count_tokens(text):
+    """Token count of the text with tiktoken, falling back to estimate_tokens"""
+    encoding = _token_encoding()
+    return len(encoding.encode(str(text), disallowed_special=())) if encoding else estimate_tokens(text)
+
+@dataclass
+class CorrectionResult:
+    """Outcome of the bounded self-correction loop"""
+    status: str # Successful, Max attempts reached, Time budget exceeded, Token budget exceeded or Cycle detected
+    sql: str
+    error_msg: str = ""
+    attempts: list = field(default_factory=list) # One dict per validation: sql, error_msg, validate_s, correct_s, tokens
+    elapsed_s: float = 0.0
+    tokens: int = 0
+    source: str = "generated" # generated, library (served from the SQL library) or saved (a saved query that still validates)
+
+    @property
+    def successful(self):
+        return self.status == "Successful"
+
+def run_correction_loop(question,query,table_schema,max_attempts=None,time_budget_s=None,token_budget=None):
+    """Validate the query and let the LLM correct it until it runs, within an attempt, wall-clock and token budget.
+    Stops early when the same query fails with the same error twice since another correction would not help"""
+    max_attempts = max_attempts or int(os.getenv("SQLGEN_CORRECTION_MAX_ATTEMPTS", 5))
+    time_budget_s = time_budget_s or float(os.getenv("SQLGEN_CORRECTION_TIME_BUDGET", 120))
+    token_budget = token_budget or int(os.getenv("SQLGEN_CORRECTION_TOKEN_BUDGET", 100000))
+
+    start = time.monotonic()
+    result = CorrectionResult(status="Max attempts reached", sql=query)
+    seen = set()
+    tracer = get_tracer()
+    with tracer.span("correction.loop", question=str(question)[:200]) as loop_span:
+        for attempt in range(1, max_attempts+1):
+            with tracer.span("correction.attempt", attempt=attempt) as attempt_span:
+                validate_start = time.monotonic()
+                error_msg = error_check(result.sql,table_schema)
+                attempt_info = {'attempt': attempt, 'sql': result.sql, 'error_msg': error_msg,
+                                'validate_s': time.monotonic() - validate_start, 'correct_s': 0.0, 'tokens': 0}
+                result.attempts.append(attempt_info)
+                result.error_msg = "" if error_msg == "Successful" else error_msg
+                attempt_span.set(valid=error_msg == "Successful")
+                if error_msg == "Successful":
+                    result.status = "Successful"
+                    break
+
+                key = (" ".join(result.sql.split()).lower(), error_msg)
+                if key in seen:
+                    result.status = "Cycle detected"
+                    break
+                seen.add(key)
+                if attempt == max_attempts: break
+
+                prompt_tokens = count_tokens(question) + count_tokens(result.sql) + count_tokens(table_schema) + count_tokens(error_msg)
+                if time.monotonic() - start >= time_budget_s:
+                    result.status = "Time budget exceeded"
+                    break
+                if result.tokens + prompt_tokens > token_budget:
+                    result.status = "Token budget exceeded"
+                    break
+
+                correct_start = time.monotonic()
+                modified_query = correct_sql(question,result.sql,table_schema,error_msg)
+                attempt_info['correct_s'] = time.monotonic() - correct_start
+                attempt_info['tokens'] = prompt_tokens + count_tokens(modified_query)
+                result.tokens += attempt_info['tokens']
+                result.sql = extract_sql(modified_query)
+        loop_span.set(outcome=result.status, attempts=len(result.attempts), tokens=result.tokens)
+
+    result.elapsed_s = time.monotonic() - start
+    return result
+
+SQL_CANDIDATE_VARIANTS = [ # (temperature, extra instruction) of each candidate. Candidate 0 is the create_sql prompt
+    (0.0, ""),
+    (0.3, "Write the query with CTEs, one for each step of the calculation."),
+    (0.5, "Before writing the query, check which table holds each column the question needs and only join on keys shown in the SCHEMA."),
+    (0.7, "Write the simplest query that answers the question, using a join or an aggregate instead of subqueries where possible."),
+]
+
+CREATE_SQL_CANDIDATE_TEMPLATE = CREATE_SQL_TEMPLATE.replace("    OUTPUT:", "    {hint}\n\n    OUTPUT:")
+
+def create_sql_candidate(question,table_schema,variant):
+    """One SQL candidate for the question. Variant 0 is create_sql, the others vary the instructions and the temperature"""
+    if variant == 0: return create_sql(question,table_schema)
+    temperature, hint = SQL_CANDIDATE_VARIANTS[variant % len(SQL_CANDIDATE_VARIANTS)]
+    temperature = min(1.0, temperature + 0.1 * (variant // len(SQL_CANDIDATE_VARIANTS)))
+    llm_chain = get_llm_chain(CREATE_SQL_CANDIDATE_TEMPLATE,temperature=temperature)
+    table_schema = prune_schema_context(question,schema_text(table_schema))
+    response = invoke_llm_chain(f'create_sql_candidate_{variant}',llm_chain,{'question':question,'table_schema':table_schema,'hint':hint})
+    return response['text']
+
+def _candidate_attempt(question,table_schema,variant):
+    """Generate and validate one candidate. Returns an attempt dict as recorded by run_correction_loop"""
+    generate_start = time.monotonic()
+    response = create_sql_candidate(question,table_schema,variant)
+    sql_code = extract_sql(response)
+    validate_start = time.monotonic()
+    error_msg = error_check(sql_code,table_schema)
+    return {'attempt': variant+1, 'variant': variant, 'sql': sql_code, 'error_msg': error_msg, 'generate_s': validate_start - generate_start,
+            'validate_s': time.monotonic() - validate_start, 'correct_s': 0.0,
+            'tokens': count_tokens(question) + count_tokens(table_schema) + count_tokens(response)}
+
+def _result_fingerprint(sql_code):
+    """Fingerprint of the (row capped) result of a query, independent of the row and column order. None if it fails"""
+    try:
+        df = load_sample_from_databricks(sql_code)
+    except Exception:
+        return None
+    rows = sorted(json.dumps(sorted(map(str, row))) for row in df.astype(str).itertuples(index=False, name=None))
+    return hashlib.sha256("\n".join(rows).encode()).hexdigest()
+
+def _generate_and_validate_sql(question,table_schema,n_candidates=None,mode=None):
+    """Generate SQL for the question and make sure it validates. Returns a CorrectionResult.
+
+    With one candidate (the default, SQLGEN_SQL_CANDIDATES) this is create_sql followed by run_correction_loop.
+    With more, the candidates are generated and validated concurrently with varied prompts and temperatures. Mode
+    "first" (SQLGEN_SQL_CANDIDATE_MODE) returns the first candidate that validates; mode "agreement" runs every
+    valid candidate and returns the one whose result most candidates agree on. The correction loop only runs when
+    no candidate validates, starting from candidate 0.
+    """
+    n_candidates = int(n_candidates or os.getenv("SQLGEN_SQL_CANDIDATES", 1))
+    mode = mode or os.getenv("SQLGEN_SQL_CANDIDATE_MODE", "first")
+    if n_candidates <= 1:
+        return run_correction_loop(question,extract_sql(create_sql(question,table_schema)),table_schema)
+
+    start = time.monotonic()
+    attempts = []
+    with get_tracer().span("sql.candidates", candidates=n_candidates, mode=mode) as span:
+        futures = [submit_background(_candidate_attempt,question,table_schema,variant) for variant in range(n_candidates)]
+        for future in as_completed(futures):
+            try:
+                attempts.append(future.result())
+            except Exception as e:
+                logger.warning("SQL candidate failed: %s", e)
+                continue
+            if mode == "first" and attempts[-1]['error_msg'] == "Successful":
+                for pending in futures: pending.cancel() # Candidates already running finish in the background
+                break
+
+        valid = sorted((attempt for attempt in attempts if attempt['error_msg'] == "Successful"), key=lambda attempt: attempt['variant'])
+        chosen = valid[0] if valid else None
+        if mode == "agreement" and len(valid) > 1:
+            executions = {attempt['variant']: submit_background(_result_fingerprint,attempt['sql']) for attempt in valid}
+            fingerprints = {variant: execution.result() for variant, execution in executions.items()}
+            votes = Counter(fingerprint for fingerprint in fingerprints.values() if fingerprint is not None)
+            if votes:
+                best = max(votes.values())
+                chosen = next(attempt for attempt in valid if fingerprints[attempt['variant']] is not None and votes[fingerprints[attempt['variant']]] == best)
+                span.set(agreement=best)
+        span.set(valid=len(valid), chosen=chosen['variant'] if chosen else None)
+
+    tokens = sum(attempt['tokens'] for attempt in attempts)
+    if chosen is not None:
+        return CorrectionResult(status="Successful", sql=chosen['sql'], attempts=sorted(attempts, key=lambda attempt: attempt['variant']),
+                                elapsed_s=time.monotonic() - start, tokens=tokens)
+
+    first = min(attempts, key=lambda attempt: attempt['variant'])['sql'] if attempts else extract_sql(create_sql(question,table_schema))
+    result = run_correction_loop(question,first,table_schema)
+    result.attempts = sorted(attempts, key=lambda attempt: attempt['variant']) + result.attempts
+    result.tokens += tokens
+    result.elapsed_s = time.monotonic() - start
+    return result
+
+def generate_valid_sql(question,table_schema,n_candidates=None,mode=None,saved_sql=None):
+    """Validated SQL for the question. Returns a CorrectionResult.
+
+    The shared SQL library is consulted first and serves a query that validated for the same question on the same
+    catalogs/schemas without any LLM call. Otherwise saved_sql (e.g. the query stored with a favourite) is validated
+    and only corrected if needed, and failing that the SQL is generated (see _generate_and_validate_sql). Queries
+    that validate are added to the library.
+    """
+    start = time.monotonic()
+    sql_code = validated_sql(question,table_schema)
+    if sql_code is not None:
+        return CorrectionResult(status="Successful", sql=sql_code, elapsed_s=time.monotonic() - start, source="library")
+
+    result = None
+    if saved_sql:
+        result = run_correction_loop(question,saved_sql,table_schema)
+        result.source = "saved"
+    if result is None or not result.successful:
+        result = _generate_and_validate_sql(question,table_schema,n_candidates,mode)
+    remember_sql(question,table_schema,result)
+    return result
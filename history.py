@@ -0,0 +1,218 @@
+"""User history repository: the questions each user saved, read and written through one place.
+
+Writes are buffered in a local append-only log and flushed in parameterised multi-row INSERTs. Reads are
+parameterised, bounded by age and row count, paginated and de-duplicated in SQL. The most recent questions of
+each user are kept in memory and updated on add and delete, so the Favourites section does not query the warehouse
+on every rerun.
+"""
+import atexit, json, os, threading, time
+import pandas as pd
+
+from engine import databricks_connection, get_tracer, logger
+
+USER_HISTORY_TABLE = "hive_metastore.dev_tools.user_query_history"
+
+class HistoryRepository:
+    """Buffered, cached access to the user history table.
+
+    Every saved question is appended (and fsynced) to a local log before anything else, so nothing is lost if
+    the app stops. The buffered events are written with one parameterised multi-row INSERT, i.e. one Delta commit,
+    once batch_size events are pending or the oldest one is flush_interval seconds old. The log is then rewritten
+    with whatever is still pending, and replayed on start. Flushes run on a background thread, outside the lock
+    that add and the reads take, so saving a question never waits for the warehouse.
+
+    Reads only cover the last max_age_days days and at most page_size distinct questions per page. The first page
+    of each user is cached and kept up to date on add and delete.
+    """
+
+    def __init__(self, log_path, table=USER_HISTORY_TABLE, batch_size=50, flush_interval=30.0, max_age_days=90, page_size=100):
+        self.log_path = log_path
+        self.table = table
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_age_days = max_age_days
+        self.page_size = page_size
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock() # One INSERT at a time, so no event is written twice
+        self._recent = {} # user -> {question: saved query} of the first page, most recent first
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._flusher = None
+        if os.path.dirname(log_path): os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        self._pending = self._read_log()
+
+    def _read_log(self):
+        """Events logged but not yet written to the warehouse"""
+        events = []
+        if os.path.exists(self.log_path):
+            with open(self.log_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        events.append(json.loads(line))
+                    except ValueError:
+                        pass # Partially written last line
+        return events
+
+    def _rewrite_log(self):
+        """Replace the log with the events still pending"""
+        temporary_path = self.log_path + ".tmp"
+        with open(temporary_path, "w", encoding="utf-8") as f:
+            for event in self._pending: f.write(json.dumps(event) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.log_path)
+
+    def _execute(self, statement, parameters, span_name, **attributes):
+        """Run a parameterised statement on a pooled connection and return its rows (None for statements without a result)"""
+        with databricks_connection() as con:
+            with con.cursor() as cursor:
+                with get_tracer().span(span_name, **attributes):
+                    cursor.execute(statement, parameters)
+                    return cursor.fetchall() if cursor.description else None
+
+    def add(self, user_name, question, query, favourite_ind=True):
+        """Log a saved question and wake the background flusher if the batch is full or old enough"""
+        event = {'user_name': user_name, 'timestamp': pd.Timestamp.now(tz="UTC").strftime("%Y-%m-%d %H:%M:%S.%f"),
+                 'question': question, 'query': query, 'favourite_ind': bool(favourite_ind), 'logged_at': time.time()}
+        with self._lock:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(event) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self._pending.append(event)
+            if user_name in self._recent:
+                recent = [(question, query)] + [(saved, sql) for saved, sql in self._recent[user_name].items() if saved != question]
+                self._recent[user_name] = dict(recent[:self.page_size])
+            due = len(self._pending) >= self.batch_size or time.time() - self._pending[0]['logged_at'] >= self.flush_interval
+        self._start_flusher()
+        if due: self._wake.set()
+
+    def flush(self):
+        """Write every pending event to the warehouse in a single INSERT. Returns the number of rows written"""
+        with self._flush_lock:
+            with self._lock:
+                events = list(self._pending)
+            if not events: return 0
+            rows, parameters = [], {}
+            for i, event in enumerate(events):
+                rows.append(f"(:user_name_{i}, CAST(:timestamp_{i} AS TIMESTAMP), :question_{i}, :query_{i}, :favourite_ind_{i})")
+                parameters.update({f"{column}_{i}": event[column] for column in ('user_name', 'timestamp', 'question', 'query', 'favourite_ind')})
+            # By position, as the table was created: user_name, timestamp, question, query, favourite indicator
+            statement = f"INSERT INTO {self.table} VALUES " + ", ".join(rows)
+            self._execute(statement, parameters, "history.flush", rows=len(events))
+            with self._lock:
+                # Events added or deleted while the INSERT ran are left as they are
+                flushed = {id(event) for event in events}
+                self._pending = [event for event in self._pending if id(event) not in flushed]
+                self._rewrite_log()
+            return len(events)
+
+    def _start_flusher(self):
+        """Flush in the background when add wakes the thread, and every flush_interval seconds so a quiet session still writes its events"""
+        with self._lock:
+            if self._flusher is not None: return
+            self._flusher = threading.Thread(target=self._flush_periodically, name="sqlgen-history-flush", daemon=True)
+            self._flusher.start()
+
+    def _flush_periodically(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._stop.is_set(): return
+            try:
+                self.flush()
+            except Exception:
+                logger.warning("Could not flush the user history, the events stay in %s", self.log_path, exc_info=True)
+
+    def close(self):
+        """Stop the background flusher and write what is pending"""
+        self._stop.set()
+        self._wake.set()
+        self.flush()
+
+    def page(self, user_name, page=0, page_size=None, max_age_days=None):
+        """One page of the user's history: a DataFrame of question, query and last_saved with one row per question
+        (its most recent save), most recent first. Only saves of the last max_age_days days are read"""
+        page_size = int(page_size or self.page_size)
+        max_age_days = int(self.max_age_days if max_age_days is None else max_age_days)
+        since = (pd.Timestamp.now(tz="UTC") - pd.Timedelta(days=max_age_days)).strftime("%Y-%m-%d %H:%M:%S")
+        # Only user_name, timestamp and question are named. The saved query is read by position (the fourth column)
+        statement = f"""SELECT * FROM {self.table}
+                        WHERE user_name = :user_name AND timestamp >= CAST(:since AS TIMESTAMP)
+                        QUALIFY row_number() OVER (PARTITION BY question ORDER BY timestamp DESC) = 1
+                        ORDER BY timestamp DESC LIMIT {page_size} OFFSET {int(page) * page_size}"""
+        rows = self._execute(statement, {'user_name': user_name, 'since': since}, "history.read", user=user_name, page=page)
+        return pd.DataFrame([(row[2], row[3], row[1]) for row in rows], columns=['question', 'query', 'last_saved'])
+
+    def questions(self, user_name):
+        """The user's most recently saved questions (first page), from the cache after the first read"""
+        with self._lock:
+            if user_name in self._recent: return list(self._recent[user_name])
+        saved = list(self.page(user_name)[['question', 'query']].itertuples(index=False, name=None))
+        with self._lock:
+            if user_name not in self._recent:
+                pending = [(event['question'], event['query']) for event in reversed(self._pending) if event['user_name'] == user_name]
+                recent = {}
+                for question, query in pending + saved: recent.setdefault(question, query)
+                self._recent[user_name] = dict(list(recent.items())[:self.page_size])
+            return list(self._recent[user_name])
+
+    def saved_query(self, user_name, question):
+        """The query last saved with one of the user's recent questions, or None"""
+        self.questions(user_name)
+        with self._lock:
+            return self._recent.get(user_name, {}).get(question)
+
+    def delete(self, user_name, question):
+        """Remove a question from the user's history, including events not flushed yet"""
+        with self._lock:
+            remaining = [event for event in self._pending if not (event['user_name'] == user_name and event['question'] == question)]
+            if len(remaining) != len(self._pending):
+                self._pending = remaining
+                self._rewrite_log()
+            self._recent.pop(user_name, None) # The next read brings in the question that moves onto the first page
+        with self._flush_lock: # An INSERT already running may hold the question, delete after it
+            self._execute(f"DELETE FROM {self.table} WHERE question = :question AND user_name = :user_name",
+                          {'question': question, 'user_name': user_name}, "history.delete", user=user_name)
+
+_history_repository = None
+_history_repository_lock = threading.Lock()
+
+def get_history_repository():
+    """Get the process-wide user history repository, creating it on first use"""
+    global _history_repository
+    with _history_repository_lock:
+        if _history_repository is None:
+            _history_repository = HistoryRepository(os.getenv("SQLGEN_HISTORY_LOG_PATH", os.path.join(".cache", "history_log.jsonl")),
+                                                    batch_size=int(os.getenv("SQLGEN_HISTORY_BATCH_SIZE", 50)),
+                                                    flush_interval=float(os.getenv("SQLGEN_HISTORY_FLUSH_INTERVAL", 30)),
+                                                    max_age_days=int(os.getenv("SQLGEN_HISTORY_MAX_AGE_DAYS", 90)),
+                                                    page_size=int(os.getenv("SQLGEN_HISTORY_PAGE_SIZE", 100)))
+            atexit.register(_history_repository.close)
+        return _history_repository
+
+def set_history_repository(repository):
+    """Replace the process-wide user history repository"""
+    global _history_repository
+    with _history_repository_lock:
+        _history_repository = repository
+
+def user_query_history(user_name, page=0, max_age_days=20):
+    """Load one page of the user's history (question, query, last_saved)"""
+    return get_history_repository().page(user_name, page=page, max_age_days=max_age_days)
+
+def add_to_user_history(user_name,question,query,favourite_ind):
+    """Add the selected question to the user history"""
+    get_history_repository().add(user_name,question,query,favourite_ind)
+
+def get_user_history_questions(user_name):
+    """"Get user's favourite questions"""
+    return pd.DataFrame({'question': get_history_repository().questions(user_name)})
+
+def get_saved_query(user_name, question):
+    """Get the query saved with one of the user's favourite questions"""
+    return get_history_repository().saved_query(user_name, question)
+
+def delete_question_from_user_history(user_name, question_to_delete):
+    """Delete the question from the user's favourites"""
+    get_history_repository().delete(user_name,question_to_delete)